@@ -17,7 +17,8 @@ CREATE TABLE IF NOT EXISTS weather (
     wind_kph FLOAT,
     wind_az FLOAT,
     precip VARCHAR(255),
-    PRIMARY KEY (id)
+    PRIMARY KEY (id),
+    UNIQUE KEY (station, time_stamp)
 );
 
 CREATE TABLE IF NOT EXISTS images (
@@ -27,6 +28,7 @@ CREATE TABLE IF NOT EXISTS images (
     path VARCHAR(255),
     res_x INT, res_y INT,
     azimuth FLOAT, tilt FLOAT, zoom FLOAT,
+    watermark_unreadable TINYINT,
     night_mode TINYINT,
     feature_min FLOAT,
     feature_max FLOAT,
@@ -34,5 +36,33 @@ CREATE TABLE IF NOT EXISTS images (
     feature_median FLOAT,
     feature_grad_x_entropy FLOAT,
     feature_grad_y_entropy FLOAT,
-    PRIMARY KEY (id)
-);
\ No newline at end of file
+    PRIMARY KEY (id),
+    UNIQUE KEY (path),
+    KEY time_stamp_id (time_stamp, id)
+);
+
+CREATE TABLE IF NOT EXISTS image_weather (
+    image_id INT NOT NULL,
+    weather_id INT NOT NULL,
+    dt_seconds FLOAT,
+    PRIMARY KEY (image_id)
+);
+
+CREATE TABLE IF NOT EXISTS labels (
+    image_id INT NOT NULL,
+    label VARCHAR(64) NOT NULL,
+    value TINYINT,
+    PRIMARY KEY (image_id, label)
+);
+
+-- For tables created before these keys were unique:
+-- ALTER TABLE images ADD UNIQUE KEY (path);
+-- ALTER TABLE weather ADD UNIQUE KEY (station, time_stamp);
+
+-- For tables created before images were indexed by time (used to page
+-- through images in order, see tools/labeling.py):
+-- ALTER TABLE images ADD KEY time_stamp_id (time_stamp, id);
+
+-- For tables created before frames whose watermark can't be read were
+-- marked (so watermarks.py skips them on later runs):
+-- ALTER TABLE images ADD COLUMN watermark_unreadable TINYINT;
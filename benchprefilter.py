@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark a capture prefilter (see tools/prefilter.py) by replaying a
+local archive, one station at a time in time order, as the scraper
+would see it.
+
+Runs on a single core where the platform allows pinning, and reports
+per-frame latency of the thumbnail and scoring steps, peak memory, and
+how many bytes would have been uploaded with and without the
+prefilter at each --threshold.
+
+    ./benchprefilter.py ~/Data/Storage/AlertWF --station Brightwood \\
+        --scorer anomaly --threshold 2 --threshold 3 --threshold 4
+'''
+
+import os, resource, time, tracemalloc
+from tools.imgtools import make_thumbnail
+from tools.metrics import percentile
+from tools.prefilter import get_scorer
+from typing import Iterator, List, Optional, Tuple
+
+def replay(root: str, stations: List[str], limit: Optional[int]=None) -> Iterator[Tuple[str, bytes]]:
+    for base in stations:
+        folder = os.path.join(root, base)
+        fnames = sorted(f for f in os.listdir(folder)
+                        if f.startswith(base + '_') and f.endswith('.jpg'))
+        for fname in fnames[:limit]:
+            with open(os.path.join(folder, fname), 'rb') as src:
+                yield base, src.read()
+
+def percentiles(values: List[float]) -> str:
+    return 'p50 %6.1fms  p95 %6.1fms  max %6.1fms' % (
+        1000*percentile(values, 0.5), 1000*percentile(values, 0.95), 1000*percentile(values, 1.0))
+
+def do_benchmark(root: str, stations: List[str], scorer_name: str, \
+                 thresholds: List[float], limit: Optional[int]=None) -> None:
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+
+    scorer = get_scorer(scorer_name)
+    thumb_times: List[float] = []
+    score_times: List[float] = []
+    full_bytes: List[int] = []
+    small_bytes: List[int] = []
+    scores: List[float] = []
+
+    tracemalloc.start()
+    for base, img in replay(root, stations, limit):
+        t0 = time.perf_counter()
+        small = make_thumbnail(img, area=250000)
+        t1 = time.perf_counter()
+        scores.append(scorer(base, small))
+        t2 = time.perf_counter()
+        thumb_times.append(t1 - t0)
+        score_times.append(t2 - t1)
+        full_bytes.append(len(img))
+        small_bytes.append(len(small))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n = len(scores)
+    baseline = sum(full_bytes) + sum(small_bytes)
+    print(f'Frames:     {n} from {len(stations)} station(s), scorer "{scorer_name}"')
+    print('Thumbnail: ', percentiles(thumb_times))
+    print('Score:     ', percentiles(score_times))
+    print('Peak memory: %.1f MB traced, %.1f MB max RSS' % (
+        peak/1024**2, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
+    print('Uploaded without prefilter: %.1f MB' % (baseline/1024**2))
+    for threshold in thresholds:
+        kept = [s >= threshold for s in scores]
+        gated = sum(small_bytes) + sum(b for b, k in zip(full_bytes, kept) if k)
+        print('  threshold %5.2f: %5.1f%% full, %.1f MB uploaded (%.1f%% less)' % (
+            threshold, 100*sum(kept)/max(1, n), gated/1024**2,
+            100*(1 - gated/max(1, baseline))))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('archive', help='Local archive directory, as written by scraper.py.')
+    parser.add_argument('--station', action='append', default=None,
+                        help='Station folder to replay, e.g. Brightwood. Default: all.')
+    parser.add_argument('--scorer', default='anomaly',
+                        help='Scorer name or module:attribute, as for scraper.py --prefilter.')
+    parser.add_argument('--threshold', type=float, action='append', default=None,
+                        help='Score threshold to report upload savings for (may be repeated).')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Maximum number of frames to replay per station.')
+    args = parser.parse_args()
+
+    root = os.path.abspath(os.path.expanduser(args.archive))
+    stations = args.station or [d for d in sorted(os.listdir(root))
+                                if d != 'metadata' and os.path.isdir(os.path.join(root, d))]
+    do_benchmark(root, stations, args.scorer, args.threshold or [3.0], args.limit)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the whole capture pipeline offline, against a local replay of
+the AlertWildfire bucket (see tools/replayserver.py).
+
+The replay server runs in its own process, so that the CPU time and
+peak memory reported are the scraper's alone. The scraper writes to a
+temporary local directory, or with --fake-s3 to an in-process S3 mock
+(requires moto). Reports frames stored per second, latency percentiles
+of each stage (fetch, EXIF, resize, score, store) from the scraper's own
+metrics, CPU time and peak RSS. Rates are per second spent sweeping, not
+waiting between sweeps for the next one to be due.
+
+Record a few frames from the live bucket once:
+
+    ./benchscraper.py record recording/ -s Axis-Brightwood -s Axis-Alpine --frames 10
+
+then replay them as many times as needed:
+
+    ./benchscraper.py run recording/ --stations 200 --latency 0.05 --concurrency 16 --sweeps 5
+'''
+
+import os, resource, shutil, tempfile, time
+import multiprocessing as mp
+from tools.metrics import percentile
+from typing import Any, Dict, List, Optional
+
+STAGES = ['fetch', 'exif', 'resize', 'score', 'store']
+
+def serve(recording: str, stations: Optional[int], latency: float, \
+          frame_interval: float, info: Any, done: Any) -> None:
+    from tools.replayserver import Recording, ReplayServer
+    with ReplayServer(Recording(recording), stations, latency, frame_interval) as server:
+        info.put((server.url, server.stations))
+        done.wait()
+        info.put(server.requests)
+
+def percentiles(values: List[float]) -> str:
+    return 'p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  (n=%d)' % (
+        1000*percentile(values, 0.5), 1000*percentile(values, 0.95),
+        1000*percentile(values, 0.99), len(values))
+
+def do_benchmark(recording: str, stations: Optional[int], latency: float, \
+                 frame_interval: float, sweeps: int, delay: float, concurrency: int, \
+                 fake_s3: bool, opts: Dict[str, Any]) -> None:
+    info, done = mp.Queue(), mp.Event()
+    server = mp.Process(target=serve, args=(recording, stations, latency, frame_interval, info, done))
+    server.start()
+    url, names = info.get()
+
+    import scraper
+    import tools.alertwf
+    tools.alertwf.BASE_URL = url
+
+    tmpdir = tempfile.mkdtemp(prefix='alertwf-bench-')
+    mock = None
+    try:
+        if fake_s3:
+            try:
+                from moto import mock_aws as mock_s3 # type: ignore
+            except ImportError:
+                from moto import mock_s3 # type: ignore
+            import boto3 # type: ignore
+            mock = mock_s3()
+            mock.start()
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='bench')
+            dest = 's3://bench/AlertWildfire'
+        else:
+            dest = os.path.join(tmpdir, 'archive')
+
+        sc = scraper.ImageScraper(names, dest, tmpdir, 'silent', concurrency, **opts)
+        ## Keep every stage timing, not just the most recent ones.
+        sc.metrics.nsamples = 10**7
+
+        usage0 = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.time()
+        sc.run(delay, sweeps)
+        wall = time.time() - t0
+        usage1 = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if mock is not None:
+            mock.stop()
+        done.set()
+        requests = info.get()
+        server.join()
+        shutil.rmtree(tmpdir)
+
+    frames = sum(st['i'] for st in sc.stations.values())
+    busy = sc.metrics.counters.get('alertwf_sweep_seconds_total', {}).get((), 0.0)
+    cpu = (usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime)
+    print(f'Stations: {len(names)}  Sweeps: {sweeps}  Concurrency: {concurrency}  '
+          f'Latency: {1000*latency:.0f}ms  Destination: {"fake S3" if fake_s3 else "local"}')
+    print('Requests:  %d images, %d not modified, %d metadata' % (
+        requests['image'], requests['not_modified'], requests['metadata']))
+    print('Frames:    %d stored in %.1fs of sweeps, %.2f frames/s' % (frames, busy, frames/max(busy, 1e-9)))
+    print('Wall time: %.1fs, including waits between sweeps' % wall)
+    for stage in STAGES:
+        if sc.metrics.samples.get(stage):
+            print(f'{stage.capitalize()+":":10s}', percentiles(sc.metrics.samples[stage]))
+    print('CPU time:  %.2fs (%.1f%% of one core while sweeping), %.1fms per frame' % (
+        cpu, 100*cpu/max(busy, 1e-9), 1000*cpu/max(frames, 1)))
+    print('Peak RSS:  %.1f MB' % (usage1.ru_maxrss/1024))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rec = sub.add_parser('record', help='Record frames and metadata from the live bucket.')
+    rec.add_argument('recording', help='Directory to save the recording in.')
+    rec.add_argument('-s', '--station', required=True, action='append',
+                     help='Name of a camera station to record.')
+    rec.add_argument('--frames', type=int, default=10, help='Number of frames to record.')
+    rec.add_argument('--interval', type=float, default=30,
+                     help='Seconds between recorded frames.')
+
+    run = sub.add_parser('run', help='Replay a recording through the scraper.')
+    run.add_argument('recording', help='Directory of a recording.')
+    run.add_argument('--stations', type=int, default=None,
+                     help='Number of stations to serve (default: those recorded).')
+    run.add_argument('--latency', type=float, default=0.0,
+                     help='Seconds added to every response.')
+    run.add_argument('--frame-interval', type=float, default=10,
+                     help='Seconds between new frames from each station.')
+    run.add_argument('--sweeps', type=int, default=5, help='Number of polling sweeps.')
+    run.add_argument('--delay', type=float, default=10,
+                     help='Seconds between sweeps, as for scraper.py.')
+    run.add_argument('--concurrency', type=int, default=1)
+    run.add_argument('--archive', choices=['frames', 'packed'], default='frames')
+    run.add_argument('--dedup', choices=['off', 'flag', 'drop'], default='off')
+    run.add_argument('--prefilter', default=None)
+    run.add_argument('--fake-s3', action='store_true',
+                     help='Store to an in-process S3 mock instead of a local directory.')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        from tools.replayserver import record
+        record(args.recording, args.station, args.frames, args.interval)
+    else:
+        opts = dict(archive=args.archive, dedup=args.dedup, prefilter=args.prefilter)
+        do_benchmark(args.recording, args.stations, args.latency, args.frame_interval,
+                     args.sweeps, args.delay, args.concurrency, args.fake_s3, opts)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''
+Run the image scraper as several worker processes, each capturing its
+own share of the stations.
+
+Stations are split using leases in a lock directory (see
+tools/leases.py). Workers on other hosts can join by pointing at the
+same --lock-dir, and when a worker dies its stations are picked up by
+the others once its leases expire. Every worker writes to the same
+destination with the same key layout as scraper.py. Metadata is logged
+by whichever worker holds the "@metadata" lease. Workers on one host
+share --tmpdir, and with --metrics-port each serves its metrics on its
+own port, counting up from the one given. Workers that exit are
+restarted, with a growing delay if they keep exiting soon after they
+start, and given up on if that happens too many times in a row.
+
+Send SIGTERM or SIGINT to shut down cleanly.
+
+    ./coordinator.py -s all --workers 4 --delay 20 s3://my-bucket/AlertWildfire
+'''
+
+import os, queue, signal, socket, sys, tempfile, time
+import multiprocessing as mp
+from scraper import ImageScraper
+from tools.alertwf import get_station_list
+from tools.leases import StationLeases
+from typing import Any, Dict, List
+
+METADATA_LEASE = '@metadata'
+
+## Dead workers are restarted after a delay that doubles with each
+## consecutive exit within FAST_EXIT seconds of starting, and their slot
+## is given up after MAX_FAST_EXITS of those in a row.
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+FAST_EXIT = 60.0
+MAX_FAST_EXITS = 5
+
+def worker_main(worker_id: str, slot: int, stations: List[str], dest: str, lockdir: str, \
+                opts: Dict[str, Any], reports: Any) -> None:
+    port = opts['metrics_port'] + slot if opts['metrics_port'] else None
+    sc = ImageScraper([], dest, opts['tmpdir'], loglevel='silent', concurrency=opts['concurrency'],
+                      manifest=opts['manifest'], max_delay=opts['max_delay'],
+                      dedup=opts['dedup'], dedup_level=opts['dedup_level'],
+                      upload_workers=opts['upload_workers'], upload_queue=opts['upload_queue'],
+                      archive=opts['archive'], prefilter=opts['prefilter'],
+                      threshold=opts['threshold'], metrics_log=opts['metrics_log'],
+                      metrics_port=port)
+    sc.delay = opts['delay']
+    signal.signal(signal.SIGTERM, sc.stop)
+    signal.signal(signal.SIGINT, sc.stop)
+
+    leases = StationLeases(lockdir, worker_id, opts['lease_ttl'])
+    try:
+        while not sc.stop_event.is_set():
+            held = leases.refresh(stations + [METADATA_LEASE])
+            sc.log_metadata = METADATA_LEASE in held
+            held.discard(METADATA_LEASE)
+            for name in held - set(sc.stations):
+                sc.add_station(name)
+            for name in set(sc.stations) - held:
+                sc.remove_station(name)
+
+            msgs = sc.capture()
+            reports.put(dict(worker=worker_id, stations=len(held), polled=len(msgs),
+                             errors=sum(' Error ' in m or m.startswith('Error') for m in msgs),
+                             sweep=sc.sweep_time, time=time.time()))
+
+            ## Wake up in time to renew leases even if no station is due.
+            sc.stop_event.wait(min(sc.next_due(), opts['lease_ttl']/3))
+    finally:
+        leases.release_all()
+        sc.close()
+
+class Coordinator():
+    def __init__(self, stations: List[str], dest: str, nworkers: int, \
+                 lockdir: str, opts: Dict[str, Any], quiet: bool=False) -> None:
+        self.stations = stations
+        self.dest = dest
+        self.nworkers = nworkers
+        self.lockdir = lockdir
+        self.opts = opts
+        self.quiet = quiet
+        self.reports = mp.Queue()
+        self.status: Dict[str, Dict[str, Any]] = dict()
+        self.workers: Dict[str, mp.Process] = dict()
+        self.slots: Dict[str, int] = dict()
+        self.started: Dict[str, float] = dict()
+        self.fast_exits: Dict[str, int] = dict()
+        self.restart_at: Dict[str, float] = dict()
+        self.stopping = False
+
+    def spawn(self, worker_id: str) -> None:
+        slot = self.slots.setdefault(worker_id, len(self.slots))
+        proc = mp.Process(target=worker_main, name=worker_id,
+                          args=(worker_id, slot, self.stations, self.dest, self.lockdir,
+                                self.opts, self.reports))
+        proc.start()
+        self.workers[worker_id] = proc
+        self.started[worker_id] = time.time()
+
+    def stop(self, *args) -> None:
+        self.stopping = True
+        for proc in self.workers.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGTERM)
+
+    def progress(self) -> str:
+        now = time.time()
+        live = [s for s in self.status.values() if now - s['time'] < self.opts['lease_ttl']]
+        return ('Workers: %d  Stations: %d/%d  Polled: %d  Errors: %d  Slowest sweep: %.1fs'
+                % (len(live), sum(s['stations'] for s in live), len(self.stations),
+                   sum(s['polled'] for s in live), sum(s['errors'] for s in live),
+                   max([s['sweep'] for s in live] or [0])))
+
+    def run(self) -> None:
+        host = socket.gethostname()
+        for i in range(self.nworkers):
+            self.spawn(f'{host}-w{i}')
+
+        while not self.stopping:
+            try:
+                report = self.reports.get(timeout=1)
+                self.status[report['worker']] = report
+                if not self.quiet:
+                    print(self.progress().ljust(80), end='\r')
+            except queue.Empty:
+                pass
+
+            ## Restart dead workers under the same id, so they take back
+            ## their own leases without waiting for them to expire.
+            now = time.time()
+            for worker_id, proc in list(self.workers.items()):
+                if proc.is_alive() or self.stopping:
+                    continue
+                if worker_id not in self.restart_at:
+                    fast = now - self.started[worker_id] < FAST_EXIT
+                    n = self.fast_exits[worker_id] = self.fast_exits.get(worker_id, 0) + 1 if fast else 0
+                    if n >= MAX_FAST_EXITS:
+                        print(f'\nWorker {worker_id} exited ({proc.exitcode}) {n} times in a row '
+                              + 'soon after starting, giving up on it')
+                        self.workers.pop(worker_id)
+                        continue
+                    delay = min(RESTART_DELAY * 2**n, MAX_RESTART_DELAY)
+                    self.restart_at[worker_id] = now + delay
+                    if not self.quiet:
+                        print(f'\nWorker {worker_id} exited ({proc.exitcode}), '
+                              + f'restarting in {delay:.0f}s')
+                elif now >= self.restart_at[worker_id]:
+                    self.restart_at.pop(worker_id)
+                    self.spawn(worker_id)
+            if not self.workers:
+                print('\nNo workers left')
+                break
+
+        for proc in self.workers.values():
+            proc.join()
+        if self.stopping and not self.quiet:
+            print('\nTerminated upon request')
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--station', required=True, action='append',
+                        help='Name of a camera station, or "all".')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes on this host.')
+    parser.add_argument('--lock-dir', default=None,
+                        help=('Directory for station leases. Share it between hosts '
+                            + 'to split stations across them.'))
+    parser.add_argument('--lease-ttl', type=float, default=120,
+                        help='Seconds after which an unrenewed lease is taken over.')
+    parser.add_argument('--delay', type=float, default=20,
+                        help='Seconds between attempts to poll for new imagery.')
+    parser.add_argument('--max-delay', type=float, default=None,
+                        help='Back off polling of static stations up to this many seconds.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of stations each worker captures in parallel.')
+    parser.add_argument('--dedup', choices=['off', 'flag', 'drop'], default='off',
+                        help='As for scraper.py; "flag" needs --manifest or --archive packed.')
+    parser.add_argument('--dedup-level', type=float, default=6.0)
+    parser.add_argument('--manifest', default=None,
+                        help='SQLite manifest to record each archived frame in.')
+    parser.add_argument('--prefilter', default=None,
+                        help='Store only the resized copy of frames this scorer rates below --threshold.')
+    parser.add_argument('--threshold', type=float, default=3.0)
+    parser.add_argument('--archive', choices=['frames', 'packed'], default='frames',
+                        help='As for scraper.py.')
+    parser.add_argument('--tmpdir', default=tempfile.gettempdir(),
+                        help='Local directory for spilled uploads, staged packs and camera state.')
+    parser.add_argument('--upload-workers', type=int, default=4,
+                        help='Number of concurrent S3 uploads per worker.')
+    parser.add_argument('--upload-queue', type=int, default=256,
+                        help='Maximum number of uploads waiting in memory per worker.')
+    parser.add_argument('--metrics-log', default=None,
+                        help='Append structured events from every worker to this JSON lines file.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port and the next --workers - 1.')
+    parser.add_argument('--quiet', action='store_true', help='Suppress progress output')
+    parser.add_argument('dest', metavar='destination',
+                        help='Base path of destination, as for scraper.py.')
+    args = parser.parse_args()
+    if args.archive == 'packed' and args.manifest:
+        parser.error('--archive packed lists frames in the pack indexes, not --manifest')
+    if args.dedup == 'flag' and not args.manifest and args.archive != 'packed':
+        parser.error('--dedup flag records duplicates in the manifest, so needs --manifest '
+                     + '(or --archive packed)')
+
+    dest = args.dest
+    if not dest.startswith('s3://'):
+        dest = os.path.abspath(os.path.expanduser(dest))
+
+    stations = list(sorted(args.station))
+    if 'all' in stations:
+        stations = get_station_list()
+
+    lockdir = args.lock_dir or os.path.join(tempfile.gettempdir(), 'alertwf-leases')
+    opts = dict(delay=args.delay, max_delay=args.max_delay, concurrency=args.concurrency,
+                dedup=args.dedup, dedup_level=args.dedup_level, manifest=args.manifest,
+                lease_ttl=args.lease_ttl, prefilter=args.prefilter, threshold=args.threshold,
+                archive=args.archive, tmpdir=os.path.abspath(args.tmpdir),
+                upload_workers=args.upload_workers, upload_queue=args.upload_queue,
+                metrics_log=args.metrics_log, metrics_port=args.metrics_port)
+
+    coord = Coordinator(stations, dest, args.workers, lockdir, opts, args.quiet)
+    signal.signal(signal.SIGTERM, coord.stop)
+    signal.signal(signal.SIGINT, coord.stop)
+    coord.run()
+    if not coord.stopping:
+        sys.exit(1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+'''
+Fill in the `feature_*` columns of the `images` table.
+
+Features are computed from the resized "small-" copy of each image,
+in batches spread over a process pool, and written back with bulk
+UPDATEs. Only rows whose features are still NULL are selected, so
+the script can be interrupted and rerun at any time.
+
+    ./features.py [--workers N] [--batch N] [--local-root DIR]
+'''
+
+import json, os
+from concurrent.futures import ProcessPoolExecutor
+from tools.db_util import get_sql_engine, SQL
+from tools.features import FEATURES, decode_gray, image_features
+from tools.imgtools import read_image, small_path
+from typing import Any, Dict, List, Optional, Tuple
+
+HOME = os.path.expanduser('~')
+
+def process_batch(rows: List[Tuple[int, str]], bucket: Optional[str], \
+                  local_root: Optional[str]) -> List[Dict[str, Any]]:
+    '''
+    Decode and compute features for one batch of (id, path) rows. Runs in
+    a worker process. Images that can't be read are left out.
+    '''
+    ids, images = [], []
+    for img_id, path in rows:
+        try:
+            images.append(decode_gray(read_image(small_path(path), bucket, local_root)))
+            ids.append(img_id)
+        except Exception as e:
+            print('Error reading', path, str(e))
+    feats = image_features(images)
+    return [dict(id=img_id, **{f'feature_{k}': v for k, v in f.items()})
+            for img_id, f in zip(ids, feats)]
+
+def do_features(bucket: Optional[str], local_root: Optional[str]=None, \
+                workers: Optional[int]=None, batch: Optional[int]=256) -> None:
+    params = dict(id=SQL.Integer, **{f'feature_{k}': SQL.Float for k in FEATURES})
+    update_query = SQL.text(
+        'UPDATE images SET ' +
+        ', '.join(f'feature_{k}=:feature_{k}' for k in FEATURES) +
+        ' WHERE id=:id;'
+    ).bindparams(*[SQL.bindparam(p, type_=t) for p,t in params.items()])
+
+    engine = get_sql_engine()
+    with engine.connect() as conn:
+        res = conn.execute('SELECT id, path FROM images WHERE feature_mean IS NULL ORDER BY id')
+        todo = [tuple(row) for row in res.fetchall()]
+        batches = [todo[i:i+batch] for i in range(0, len(todo), batch)]
+        print('Computing features for', len(todo), 'images')
+
+        n = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(process_batch, b, bucket, local_root) for b in batches]
+            for future in futures:
+                rows = future.result()
+                if rows:
+                    with conn.begin():
+                        conn.execute(update_query, rows)
+                n += len(rows)
+                print('%5.01f%%'%(100*n/max(1,len(todo))), end='\r')
+    print('\nUpdated', n, 'records')
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per core).')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='Number of images per batch.')
+    parser.add_argument('--local-root', default=None,
+                        help=('Read images from this directory instead of S3. '
+                            + 'Paths in the images table are relative to it.'))
+    args = parser.parse_args()
+
+    bucket = None
+    if args.local_root is None:
+        with open(os.path.join(HOME, 'Documents', 'secrets.json'),'r') as secrets_file:
+            bucket = json.load(secrets_file)['aws']['bucket']
+
+    do_features(bucket, args.local_root, args.workers, args.batch)
@@ -2,24 +2,75 @@
 
 '''
 Fetching weather data from openweathermap.org
+
+Hourly weather is requested for every station with images, for each of
+the last --days days. Stations that share a grid cell (--grid degrees)
+are served by a single request. Requests go out in parallel over a
+pooled connection, paced by a token bucket so the API's rate limit
+(--rate requests per second) is used fully but never exceeded.
+
+Responses are kept as JSON files (one per station-day, as before), and
+the parsed hourly rows are bulk loaded into the `weather` table.
 '''
 
-import json, os, requests, sys, time
-import sqlalchemy # type: ignore
+import json, os, requests, threading, time
+import sqlalchemy as SQL # type: ignore
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from urllib.parse import quote_plus
+from requests.adapters import HTTPAdapter
 
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 
 WEATHER_API = 'https://api.openweathermap.org/data/2.5/onecall/timemachine'
 
-def get_hourly_weather(lon:float, lat:float, date:datetime, api_key: str) -> Dict[str,Any]:
+class TokenBucket():
+    '''
+    Allow `rate` acquisitions per second on average, with bursts of up
+    to `capacity` after a quiet spell. The bucket starts empty, so a run
+    doesn't open with a burst on top of the steady rate. Safe to share
+    between threads.
+    '''
+    def __init__(self, rate: float, capacity: Optional[float]=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp)*self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def get_session(maxsize: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxsize)
+    session.mount('https://', adapter)
+    return session
+
+def get_hourly_weather(lon:float, lat:float, date:datetime, api_key: str, \
+                       session: Optional[requests.Session]=None, \
+                       bucket: Optional[TokenBucket]=None, \
+                       url: Optional[str]=WEATHER_API) -> Dict[str,Any]:
     dt = str(int(date.timestamp()))
     prm = dict(lon=str(lon),lat=str(lat),dt=str(dt),units='metric',appid=api_key)
-    result = requests.get(WEATHER_API, params=prm)
+    for attempt in range(5):
+        if bucket is not None:
+            bucket.acquire()
+        result = (session or requests).get(url, params=prm)
+        ## Back off if the API says we've exceeded the quota anyway.
+        if result.status_code != 429:
+            break
+        time.sleep(2**attempt)
     assert result.status_code == 200, \
         f'status code: {result.status_code}\nURL: {result.url}'
-    time.sleep(1) ## Rate-limited API
     return result.json()
 
 def days_ago(n: int) -> datetime:
@@ -27,7 +78,115 @@ def days_ago(n: int) -> datetime:
     dt = datetime.fromordinal(d.toordinal())
     return dt
 
+def grid_cell(lon: float, lat: float, size: float) -> Tuple[float, float]:
+    '''
+    Center of the `size` degree grid cell containing a point.
+    '''
+    snap = lambda v: round((v // size) * size + size/2, 6)
+    return snap(lon), snap(lat)
+
+def group_stations(stations: List[Tuple[str, float, float]], \
+                   size: float) -> Dict[Tuple[float, float], List[str]]:
+    cells: Dict[Tuple[float, float], List[str]] = dict()
+    for station, lon, lat in stations:
+        cells.setdefault(grid_cell(lon, lat, size), []).append(station)
+    return cells
+
+def parse_hourly(station: str, weather: Dict[str, Any]) -> List[Dict[str, Any]]:
+    '''
+    Rows for the `weather` table from one timemachine response.
+    '''
+    rows = []
+    for hour in weather.get('hourly', []):
+        precip = ','.join(w.get('main', '') for w in hour.get('weather', []))
+        wind = hour.get('wind_speed')
+        rows.append(dict(station=station,
+                         time_stamp=datetime.utcfromtimestamp(hour['dt']),
+                         temp_c=hour.get('temp'),
+                         wind_kph=None if wind is None else wind*3.6,
+                         wind_az=hour.get('wind_deg'),
+                         precip=precip or None))
+    return rows
+
+def fetch_cell_day(cell: Tuple[float, float], stations: List[str], dt: datetime, \
+                   weather_dir: str, api_key: str, session: requests.Session, \
+                   bucket: TokenBucket, url: str, verbose: bool) -> List[Dict[str, Any]]:
+    '''
+    Get one day of weather for a grid cell, from the saved files of any
+    of its stations if possible, and save it for every station in it.
+    '''
+    paths = [os.path.join(weather_dir, f"{st}-{dt.strftime('%Y-%m-%d')}.json") for st in stations]
+    existing = [p for p in paths if os.path.exists(p)]
+    if existing:
+        with open(existing[0], 'r') as data_file:
+            weather = json.load(data_file)
+    else:
+        lon, lat = cell
+        weather = get_hourly_weather(lon, lat, dt, api_key, session, bucket, url)
+
+    rows = []
+    for station, path in zip(stations, paths):
+        if not os.path.exists(path):
+            if verbose:
+                print('  Saving:', path)
+            with open(path, 'w') as data_file:
+                json.dump(weather, data_file)
+        rows += parse_hourly(station, weather)
+    return rows
+
+def do_weather(conn, api_key: str, weather_dir: str, days: List[int], grid: float, \
+               rate: float, workers: int, url: Optional[str]=WEATHER_API, \
+               verbose: Optional[bool]=False) -> int:
+    params = dict(station=SQL.String, time_stamp=SQL.DateTime, temp_c=SQL.Float,
+                  wind_kph=SQL.Float, wind_az=SQL.Float, precip=SQL.String)
+    insert_query = SQL.text('''
+            INSERT IGNORE INTO weather (station, time_stamp, temp_c, wind_kph, wind_az, precip)
+            VALUES (:station, :time_stamp, :temp_c, :wind_kph, :wind_az, :precip);
+        ''').bindparams(*[SQL.bindparam(p, type_=t) for p,t in params.items()])
+
+    query = ''' SELECT DISTINCT station, lon, lat FROM
+                stations st INNER JOIN images im
+                ON st.id=im.station; '''
+    stations = [tuple(r) for r in conn.execute(query).fetchall()]
+    cells = group_stations(stations, grid)
+    if verbose:
+        print(f'{len(stations)} stations in {len(cells)} grid cells, {len(days)} days')
+
+    session = get_session(workers)
+    bucket = TokenBucket(rate)
+    n = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch_cell_day, cell, sts, days_ago(d), weather_dir,
+                               api_key, session, bucket, url, verbose): (cell, d)
+                   for cell, sts in cells.items() for d in days}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                print('Error fetching', futures[future], str(e))
+                continue
+            if rows:
+                conn.execute(insert_query, rows)
+                n += len(rows)
+    return n
+
 if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from tools.db_util import get_sql_engine
+
+    parser = ArgumentParser()
+    parser.add_argument('--days', type=int, default=1,
+                        help='Number of past days to fetch, ending yesterday.')
+    parser.add_argument('--grid', type=float, default=0.1,
+                        help='Grid cell size (degrees) within which stations share weather.')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='Maximum API requests per second.')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of concurrent requests.')
+    parser.add_argument('--url', default=WEATHER_API, help='Weather API endpoint.')
+    parser.add_argument('-v', action='store_true', help='Verbose output')
+    args = parser.parse_args()
+
     ## Initialize constant variables, and ensure destination
     ## path exists.
     HOME = os.path.expanduser('~')
@@ -37,41 +196,15 @@ if __name__ == '__main__':
         os.makedirs(WEATHER_DIR)
     assert os.path.isdir(WEATHER_DIR)
 
-    ## Establish MySQL DB connection
     secrets_path = os.path.join(HOME, 'Documents', 'secrets.json')
     with open(secrets_path,'r') as secrets_file:
-        secrets = json.load(secrets_file)
-        api_key = secrets['openweathermap.org']['api_key']
-        _sql_secrets = secrets['mysql']
-        sql_passwd = quote_plus(_sql_secrets['PASSWD'])
-        sql_usr = _sql_secrets['USER']
-        sql_host = _sql_secrets['HOST']
-        sql_port = _sql_secrets['PORT']
-        sql_db = _sql_secrets['DB']
-        sql_url = f"mysql+pymysql://{sql_usr}:{sql_passwd}@{sql_host}:{sql_port}/{sql_db}"
-        sql_engine = sqlalchemy.create_engine(sql_url)
+        api_key = json.load(secrets_file)['openweathermap.org']['api_key']
 
     ## Actually perform queries and download data
-    query = ''' SELECT DISTINCT station, lon, lat FROM 
-                stations st INNER JOIN images im
-                ON st.id=im.station; '''
-    with sql_engine.connect().execution_options(autocommit=True) as conn:
-        results = conn.execute(query)
-        for station, lon, lat in results.fetchall():
-            #for n in range(5):
-            for n in [1]:
-                dt = days_ago(n)
-                fname = f"{station}-{dt.strftime('%Y-%m-%d')}.json"
-                path = os.path.join(WEATHER_DIR, fname)
-                if not os.path.exists(path):
-                    try:
-                        weather = get_hourly_weather(lon, lat, dt, api_key)
-                        if '-v' in sys.argv:
-                            print('  Saving:', path)
-                        with open(path, 'w') as data_file:
-                            json.dump(weather, data_file)
-                    except Exception as e:
-                        print('Error saving',path,str(e))
-
-    if '-v' in sys.argv:
-        print('Done!')
\ No newline at end of file
+    with get_sql_engine().connect().execution_options(autocommit=True) as conn:
+        n = do_weather(conn, api_key, WEATHER_DIR, list(range(1, args.days+1)), args.grid,
+                       args.rate, args.workers, args.url, args.v)
+
+    if args.v:
+        print('Loaded', n, 'hourly records')
+        print('Done!')
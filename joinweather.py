@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+'''
+Materialize the pairing of each image with its nearest hourly weather
+observation into the `image_weather` table (see tools/weatherjoin.py).
+
+Each run re-pairs the images of the last few days (--lookback), so it
+picks up new images, images whose weather has since arrived, and
+images for which nearer weather was backfilled. Older images are left
+as they are unless --all is given. Optionally, the full joined table is
+also written to Parquet for building training sets.
+
+    ./joinweather.py [--tolerance 90min] [--lookback 3] [--parquet image_weather.parquet]
+'''
+
+from datetime import datetime
+import pandas as pd # type: ignore
+import sqlalchemy as SQL # type: ignore
+from tools.db_util import get_sql_engine
+from tools.weatherjoin import asof_join, image_times_utc
+from typing import Optional
+
+def do_join(tolerance: pd.Timedelta, lookback: Optional[pd.Timedelta]=pd.Timedelta(days=3), \
+            parquet: Optional[str]=None) -> None:
+    '''
+    Pair the images taken within `lookback` of now (or all images, if
+    None) with their nearest weather, replacing earlier pairings.
+    '''
+    engine = get_sql_engine()
+    with engine.connect().execution_options(autocommit=True) as conn:
+        ## time_stamp is local wall-clock time, which is close enough for
+        ## a window measured in days.
+        since = datetime(1970, 1, 1) if lookback is None else datetime.now() - lookback
+        images = pd.read_sql(SQL.text('''
+            SELECT id, station, path FROM images
+            WHERE time_stamp >= :since;'''), conn, params=dict(since=since))
+        images['utc'] = image_times_utc(images['path'])
+
+        if len(images):
+            lo = images['utc'].min() - tolerance
+            hi = images['utc'].max() + tolerance
+            weather = pd.read_sql(SQL.text('''
+                SELECT id, station, time_stamp FROM weather
+                WHERE time_stamp BETWEEN :lo AND :hi;'''), conn,
+                params=dict(lo=lo.to_pydatetime(), hi=hi.to_pydatetime()))
+            joined = asof_join(images, weather, tolerance)
+
+            rows = joined[['image_id', 'weather_id', 'dt_seconds']].to_dict('records')
+            if rows:
+                conn.execute(SQL.text('''
+                    INSERT INTO image_weather (image_id, weather_id, dt_seconds)
+                    VALUES (:image_id, :weather_id, :dt_seconds)
+                    ON DUPLICATE KEY UPDATE
+                        weather_id = VALUES(weather_id), dt_seconds = VALUES(dt_seconds);'''), rows)
+            print('Paired', len(rows), 'of', len(images), 'images')
+
+        if parquet:
+            full = pd.read_sql('''
+                SELECT iw.image_id, im.station, im.path, im.time_stamp AS image_time,
+                       iw.dt_seconds, w.time_stamp AS weather_time,
+                       w.temp_c, w.wind_kph, w.wind_az, w.precip
+                FROM image_weather iw
+                INNER JOIN images im ON im.id = iw.image_id
+                INNER JOIN weather w ON w.id = iw.weather_id;''', conn)
+            full.to_parquet(parquet, index=False)
+            print('Wrote', len(full), 'rows to', parquet)
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--tolerance', type=pd.Timedelta, default=pd.Timedelta('90min'),
+                        help='Largest time difference at which weather is paired with an image.')
+    parser.add_argument('--lookback', type=float, default=3,
+                        help='Re-pair images from this many days back.')
+    parser.add_argument('--all', action='store_true',
+                        help='Re-pair every image, however old.')
+    parser.add_argument('--parquet', default=None,
+                        help='Also write the complete joined table to this Parquet file.')
+    args = parser.parse_args()
+
+    lookback = None if args.all else pd.Timedelta(days=args.lookback)
+    do_join(args.tolerance, lookback, args.parquet)
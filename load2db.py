@@ -12,12 +12,18 @@ which have been added to the S3 bucket, but not yet
 added to the database.
 
 Run it from the command line with no arguments. It'll
-do its thing.
+do its thing. Each run only lists objects newer than the
+latest image already loaded for each station, less a day
+(--lookback) for images that were uploaded late; pass
+--full to relist the whole archive, or --manifest to read
+keys from a local manifest (see tools/manifest.py).
 '''
 
-import boto3, json, os, re
-from datetime import datetime
+import boto3, json, os
+from datetime import datetime, timedelta
 from tools.db_util import get_sql_engine, SQL
+from tools.manifest import Manifest, full_key, regex_date, regex_path, rewind, thumbnail_only
+from typing import Dict, Iterator, List, Optional, Set
 
 HOME = os.path.expanduser('~')
 secrets_path = os.path.join(HOME, 'Documents', 'secrets.json')
@@ -26,46 +32,144 @@ with open(secrets_path,'r') as secrets_file:
     BUCKET_NAME = secrets['aws']['bucket']
     PREFIX = secrets['aws']['prefix']
 
-s3_resource = boto3.resource('s3')
+BATCH_SIZE = 1000
 
-def do_load(Bucket:str, Prefix:str) -> None:
+s3_client = boto3.client('s3')
+
+def list_keys(Bucket: str, Prefix: str, StartAfter: Optional[str]=None) -> Iterator[str]:
+    '''
+    Stream object keys under a prefix one page at a time, optionally
+    starting after a given key.
+    '''
+    params = dict(Bucket=Bucket, Prefix=Prefix)
+    if StartAfter:
+        params['StartAfter'] = StartAfter
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+def list_station_prefixes(Bucket: str, Prefix: str) -> List[str]:
+    '''
+    List the per-station folders directly under the archive prefix.
+    '''
+    paginator = s3_client.get_paginator('list_objects_v2')
+    prefixes = []
+    for page in paginator.paginate(Bucket=Bucket, Prefix=Prefix.rstrip('/')+'/', Delimiter='/'):
+        prefixes += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+    return [p for p in prefixes if not p.endswith('/metadata/')]
+
+def get_watermarks(conn) -> Dict[str, str]:
+    '''
+    The newest full-resolution key already loaded for each station
+    folder. Listings resume after these keys.
+    '''
+    res = conn.execute('''
+        SELECT MAX(REPLACE(path, '/small-', '/')) FROM images GROUP BY station''')
+    return {os.path.dirname(path)+'/': path for (path,) in res.fetchall() if path}
+
+def get_loaded_paths(conn) -> Set[str]:
+    res = conn.execute('SELECT path FROM images')
+    paths = set()
+    while True:
+        rows = res.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        paths.update(row[0] for row in rows)
+    return paths
+
+def parse_key(key: str) -> Optional[Dict]:
+    match = regex_path.search(key)
+    if not match:
+        return None
+    station, fname = match.groups()
+    stamp_match = regex_date.search(fname)
+    if not stamp_match:
+        return None
+    dtstamp = datetime.fromisoformat(stamp_match.groups()[0])
+    return dict(stationid=f'Axis-{station}', time_stamp=dtstamp, path=key)
+
+def new_s3_keys(Bucket: str, Prefix: str, watermarks: Dict[str, str]) -> Iterator[str]:
+    for st_prefix in list_station_prefixes(Bucket, Prefix):
+        ## Full resolution images are named "{base}/{base}_{ts}.jpg", so
+        ## they can be listed separately from the "small-" copies, and
+        ## in chronological order. Frames kept only as a "small-" copy
+        ## (see --prefilter in scraper.py) are loaded by that key.
+        base = st_prefix.rstrip('/').rsplit('/',1)[-1]
+        mark = watermarks.get(st_prefix)
+        full = list(list_keys(Bucket, f'{st_prefix}{base}_', mark))
+        small = list_keys(Bucket, f'{st_prefix}small-{base}_',
+                          mark and f'{st_prefix}small-{mark[len(st_prefix):]}')
+        yield from sorted(full + thumbnail_only(full, small), key=full_key)
+
+def new_manifest_keys(manifest: Manifest, Prefix: str, watermarks: Dict[str, str]) -> Iterator[str]:
+    for frame in manifest.query():
+        key = frame['key']
+        if key.startswith(Prefix) and full_key(key) > watermarks.get(os.path.dirname(key)+'/', ''):
+            yield key
+
+def do_load(Bucket:str, Prefix:str, full: Optional[bool]=False, \
+            manifest: Optional[Manifest]=None, \
+            lookback: Optional[timedelta]=timedelta(days=1)) -> None:
+    '''
+    Insert any full-resolution images in the bucket which aren't in the
+    `images` table yet, and the resized copies of frames that have no
+    full-resolution image. By default only keys after each station's newest
+    loaded image, less `lookback`, are listed; `full` relists every key
+    under the prefix. If a manifest is given, keys are read from it
+    instead of from S3.
+    '''
     n=0
-    
+
     params = dict(stationid=SQL.String, time_stamp=SQL.DateTime, path=SQL.String)
     insert_image_query = SQL.text('''
-            INSERT INTO images (`station`, `time_stamp`, `path`)
+            INSERT IGNORE INTO images (`station`, `time_stamp`, `path`)
             VALUES (:stationid, :time_stamp, :path);
         ''').bindparams(*[SQL.bindparam(p, type_=t) for p,t in params.items()])
 
-    regex_path = re.compile(r'([^/]*)/([^/]*.jpg)$')
-    regex_date = re.compile(r'(\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d-\d\d:\d\d)')
-
     engine = get_sql_engine()
     with engine.connect() as conn:
-        img_res = conn.execute('SELECT path FROM images')
-        img_paths = [record[0] for record in img_res.fetchall()]
+        watermarks = dict() if full else \
+            {k: rewind(v, lookback) for k, v in get_watermarks(conn).items()}
+        img_paths = get_loaded_paths(conn) if full else set()
 
         tx = conn.begin()
-        
-        bucket = s3_resource.Bucket(Bucket)
-        for obj in bucket.objects.filter(Prefix=Prefix):
-            if ('small' in obj.key) or (obj.key in img_paths):
-                continue
-            match = regex_path.search(obj.key)
-            stamp_match = regex_date.search(fname)
-            if match and stamp_match:
-                station, fname = match.groups()
-                stamp = stamp_match.groups()[0]
-
-                dtstamp = datetime.fromisoformat(stamp)
-                stationid = f'Axis-{station}'
 
-                row = dict(stationid=stationid, time_stamp=dtstamp, path=obj.key)
-                conn.execute(insert_image_query, row)
+        if manifest is not None:
+            keys = new_manifest_keys(manifest, Prefix, watermarks)
+        else:
+            keys = new_s3_keys(Bucket, Prefix, watermarks)
 
-                n += 1
+        batch = []
+        for key in keys:
+            ## Resized copies used to be named "{base}_{ts}-small.jpg"
+            if key.endswith('-small.jpg') or (key in img_paths):
+                continue
+            row = parse_key(key)
+            if row:
+                batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                conn.execute(insert_image_query, batch)
+                n += len(batch)
+                batch = []
+        if batch:
+            conn.execute(insert_image_query, batch)
+            n += len(batch)
         tx.commit()
-    print('Inserted', n, 'records')
+    print('Processed', n, 'records')
 
 if __name__ == '__main__':
-    do_load(BUCKET_NAME, PREFIX)
\ No newline at end of file
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--full', action='store_true',
+                        help='Relist the whole archive instead of only new images.')
+    parser.add_argument('--manifest', default=None,
+                        help='Read image keys from a local manifest instead of listing S3.')
+    parser.add_argument('--lookback', type=float, default=24,
+                        help='Also relist this many hours before each station\'s newest image.')
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    do_load(BUCKET_NAME, PREFIX, full=args.full, manifest=manifest,
+            lookback=timedelta(hours=args.lookback))
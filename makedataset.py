@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+'''
+Export a training dataset of images selected from the `images` table
+as fixed-shape, memory-mapped uint8 shards (see tools/shards.py).
+
+Rows are streamed from the database, decoded and resized in batches
+over a process pool, and written out in query order.
+
+    ./makedataset.py out/brightwood-smoke --station Axis-Brightwood \\
+        --after 2021-03-01 --label smoke=1 --feature mean=40: --size 320x180
+'''
+
+import json, os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from tools.db_util import get_sql_engine, SQL
+from tools.features import FEATURES
+from tools.imgtools import read_image, small_path
+from tools.shards import ShardWriter, decode_resized
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+HOME = os.path.expanduser('~')
+
+def build_query(stations: List[str], after: Optional[str], before: Optional[str], \
+                labels: Dict[str, int], features: Dict[str, Tuple[Optional[float], Optional[float]]]) \
+                -> Tuple[Any, Dict[str, Any]]:
+    where, params = [], dict()
+    if stations:
+        where.append('im.station IN :stations')
+        params['stations'] = stations
+    if after:
+        where.append('im.time_stamp >= :after')
+        params['after'] = after
+    if before:
+        where.append('im.time_stamp < :before')
+        params['before'] = before
+    for i, (label, value) in enumerate(labels.items()):
+        where.append(f'EXISTS (SELECT 1 FROM labels lb WHERE lb.image_id = im.id '
+                     f'AND lb.label = :label{i} AND lb.value = :value{i})')
+        params[f'label{i}'], params[f'value{i}'] = label, value
+    for name, (lo, hi) in features.items():
+        ## Feature names are checked against FEATURES by the caller.
+        if lo is not None:
+            where.append(f'im.feature_{name} >= :{name}_lo')
+            params[f'{name}_lo'] = lo
+        if hi is not None:
+            where.append(f'im.feature_{name} <= :{name}_hi')
+            params[f'{name}_hi'] = hi
+
+    query = SQL.text('SELECT im.id, im.station, im.time_stamp, im.path FROM images im'
+                     + (' WHERE ' + ' AND '.join(where) if where else '')
+                     + ' ORDER BY im.station, im.time_stamp;')
+    if stations:
+        query = query.bindparams(SQL.bindparam('stations', expanding=True))
+    return query, params
+
+def get_labels(conn, ids: List[int]) -> Dict[int, Dict[str, int]]:
+    res: Dict[int, Dict[str, int]] = dict()
+    if ids:
+        query = SQL.text('SELECT image_id, label, value FROM labels WHERE image_id IN :ids') \
+                   .bindparams(SQL.bindparam('ids', expanding=True))
+        for img_id, label, value in conn.execute(query, ids=ids):
+            res.setdefault(img_id, dict())[label] = value
+    return res
+
+def process_batch(rows: List[Dict[str, Any]], size: Tuple[int, int], gray: bool, \
+                  full: bool, bucket: Optional[str], local_root: Optional[str]) \
+                  -> List[Tuple[Dict[str, Any], Any]]:
+    '''
+    Read, decode and resize one batch of rows. Runs in a worker process.
+    Images that can't be read are left out.
+    '''
+    out = []
+    for row in rows:
+        path = row['path'] if full else small_path(row['path'])
+        try:
+            out.append((row, decode_resized(read_image(path, bucket, local_root), size, gray)))
+        except Exception as e:
+            print('Error reading', path, str(e))
+    return out
+
+def stream_rows(conn, label_conn, query, params: Dict[str, Any], batch: int) \
+                -> Iterator[List[Dict[str, Any]]]:
+    '''
+    Selected rows in batches, with their labels. The selection is read
+    unbuffered, so labels are looked up over a second connection.
+    '''
+    res = conn.execution_options(stream_results=True).execute(query, **params)
+    while True:
+        rows = res.fetchmany(batch)
+        if not rows:
+            return
+        rows = [dict(id=r[0], station=r[1], time_stamp=r[2], path=r[3]) for r in rows]
+        labels = get_labels(label_conn, [r['id'] for r in rows])
+        for r in rows:
+            r['labels'] = labels.get(r['id'], dict())
+        yield rows
+
+def do_export(outdir: str, query, params: Dict[str, Any], size: Tuple[int, int], \
+              gray: bool, full: bool, bucket: Optional[str], local_root: Optional[str], \
+              shard_size: int, workers: Optional[int]=None, batch: Optional[int]=256) -> int:
+    shape = (size[1], size[0], 1 if gray else 3)
+    writer = ShardWriter(outdir, shape, shard_size)
+    n = 0
+
+    engine = get_sql_engine()
+    workers = workers or os.cpu_count()
+    with engine.connect() as conn, engine.connect() as label_conn, \
+         ProcessPoolExecutor(max_workers=workers) as pool:
+        ## Keep a couple of batches in flight per worker, and write them
+        ## out in order as they finish.
+        pending: deque = deque()
+        depth = 2 * workers
+        def drain(limit: int) -> None:
+            nonlocal n
+            while len(pending) > limit:
+                for row, img in pending.popleft().result():
+                    writer.append(img, row)
+                    n += 1
+                print('Exported', n, 'images', end='\r')
+
+        for rows in stream_rows(conn, label_conn, query, params, batch):
+            pending.append(pool.submit(process_batch, rows, size, gray, full, bucket, local_root))
+            drain(depth)
+        drain(0)
+
+    writer.close(query=str(query), params=params, source='full' if full else 'small')
+    print('\nExported', n, 'images to', len(writer.shards), 'shards')
+    return n
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    def parse_range(spec: str) -> Tuple[str, Tuple[Optional[float], Optional[float]]]:
+        name, rng = spec.split('=', 1)
+        if name not in FEATURES:
+            raise ValueError(f'Unknown feature {name}, expected one of {FEATURES}')
+        lo, hi = rng.split(':', 1)
+        return name, (float(lo) if lo else None, float(hi) if hi else None)
+
+    parser = ArgumentParser()
+    parser.add_argument('outdir', help='Directory to write the dataset to.')
+    parser.add_argument('-s', '--station', action='append', default=[],
+                        help='Station id to include, e.g. Axis-Brightwood. Default: all.')
+    parser.add_argument('--after', default=None, help='Only images at or after this time.')
+    parser.add_argument('--before', default=None, help='Only images before this time.')
+    parser.add_argument('--label', action='append', default=[],
+                        help='Only images with this label value, as LABEL=VALUE.')
+    parser.add_argument('--feature', action='append', default=[],
+                        help='Only images with a feature in range, as NAME=MIN:MAX (either may be omitted).')
+    parser.add_argument('--size', default='320x180',
+                        help='Output image size, as WIDTHxHEIGHT.')
+    parser.add_argument('--gray', action='store_true', help='Export single-channel images.')
+    parser.add_argument('--full', action='store_true',
+                        help='Resize from the full resolution images instead of the resized copies.')
+    parser.add_argument('--shard-size', type=int, default=4096,
+                        help='Number of images per shard.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per core).')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='Number of images per batch.')
+    parser.add_argument('--local-root', default=None,
+                        help=('Read images from this directory instead of S3. '
+                            + 'Paths in the images table are relative to it.'))
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.lower().split('x'))
+    labels = {k: int(v) for k, v in (l.split('=', 1) for l in args.label)}
+    features = dict(parse_range(f) for f in args.feature)
+    query, params = build_query(args.station, args.after, args.before, labels, features)
+
+    bucket = None
+    if args.local_root is None:
+        with open(os.path.join(HOME, 'Documents', 'secrets.json'),'r') as secrets_file:
+            bucket = json.load(secrets_file)['aws']['bucket']
+
+    do_export(args.outdir, query, params, size, args.gray, args.full, bucket,
+              args.local_root, args.shard_size, args.workers, args.batch)
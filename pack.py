@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+'''
+Convert an existing one-object-per-frame archive into daily packs (see
+tools/packarchive.py). Packs are written next to the original frames,
+which are left in place.
+
+    ./pack.py s3://my-bucket/AlertWildfire [--station Brightwood] [--before 2021-03-16]
+    ./pack.py /home/user/AlertWF
+'''
+
+import os, shutil, tempfile
+from datetime import datetime
+from itertools import groupby
+from tools.manifest import full_key, parse_key, thumbnail_only
+from tools.packarchive import PackWriter
+from typing import Any, List
+
+def list_frames(src: str, base: str, s3: Any=None) -> List[str]:
+    '''
+    Frame keys (or paths) for one station, in order: full resolution
+    frames, and the resized copies of frames kept as thumbnails only.
+    '''
+    if s3 is None:
+        folder = os.path.join(src, base)
+        keys = [os.path.join(folder, fname) for fname in os.listdir(folder)]
+    else:
+        bucket, prefix = src[5:].split('/', 1)
+        paginator = s3.get_paginator('list_objects_v2')
+        keys = []
+        for fname in (f'{base}_', f'small-{base}_'):
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix.rstrip('/')}/{base}/{fname}"):
+                keys += [obj['Key'] for obj in page.get('Contents', [])]
+    small = [k for k in keys if os.path.basename(k).startswith('small-')]
+    full = [k for k in keys if not os.path.basename(k).startswith('small-')]
+    return sorted(full + thumbnail_only(full, small), key=full_key)
+
+def list_stations(src: str, s3: Any=None) -> List[str]:
+    if s3 is None:
+        return [d for d in sorted(os.listdir(src))
+                if d != 'metadata' and not d.startswith('.') and os.path.isdir(os.path.join(src, d))]
+    bucket, prefix = src[5:].split('/', 1)
+    paginator = s3.get_paginator('list_objects_v2')
+    folders = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix.rstrip('/')+'/', Delimiter='/'):
+        folders += [p['Prefix'].rstrip('/').rsplit('/',1)[-1] for p in page.get('CommonPrefixes', [])]
+    return [f for f in folders if f != 'metadata']
+
+def pack_station(src: str, base: str, before: str, staging: str, s3: Any=None) -> int:
+    '''
+    Pack every complete day of one station's frames that isn't packed
+    yet. Returns the number of frames packed.
+    '''
+    def read(key: str) -> bytes:
+        if s3 is None:
+            with open(key, 'rb') as f:
+                return f.read()
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def packed(day: str) -> bool:
+        ## A pack is complete once its index is there, as that's written last.
+        if s3 is None:
+            return any(f.startswith(f'{base}_{day}.') and f.endswith('.pack.idx')
+                       for f in os.listdir(dest))
+        paginator = s3.get_paginator('list_objects_v2')
+        return any(obj['Key'].endswith('.pack.idx')
+                   for page in paginator.paginate(Bucket=bucket, Prefix=f'{dest}/{base}_{day}.')
+                   for obj in page.get('Contents', []))
+
+    if s3 is not None:
+        bucket, prefix = src[5:].split('/', 1)
+        dest = f"{prefix.rstrip('/')}/{base}"
+    else:
+        dest = os.path.join(src, base)
+
+    frames = (parse_key(k) for k in list_frames(src, base, s3))
+    frames = (f for f in frames if f is not None)
+    n = 0
+    for day, group in groupby(frames, key=lambda f: f['time_stamp'].date().isoformat()):
+        if day >= before or packed(day):
+            continue
+        ## Packs are built in staging and moved into place pack first,
+        ## index last, so an interrupted run leaves nothing to skip.
+        writer = PackWriter(staging)
+        for frame in sorted(group, key=lambda f: f['time_stamp']):
+            data = read(frame['key']) if frame['full'] else b''
+            fname, _ = writer.append(base, frame['time_stamp'], data, read(frame['small_key']))
+            n += 1
+        for f in (fname, fname + '.idx'):
+            path = os.path.join(staging, base, f)
+            if s3 is not None:
+                s3.upload_file(path, bucket, f'{dest}/{f}')
+                os.remove(path)
+            else:
+                os.replace(path, os.path.join(dest, f))
+        print('  Packed', base, day)
+    return n
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('src', metavar='archive',
+                        help='Archive to pack: a local directory or an s3:// URI.')
+    parser.add_argument('--station', action='append', default=None,
+                        help='Station folder to pack, e.g. Brightwood. Default: all.')
+    parser.add_argument('--before', default=datetime.now().date().isoformat(),
+                        help='Only pack days before this date (default: today).')
+    args = parser.parse_args()
+
+    s3 = None
+    src = args.src
+    if src.startswith('s3://'):
+        import boto3 # type: ignore
+        s3 = boto3.client('s3')
+    else:
+        src = os.path.abspath(os.path.expanduser(src))
+
+    ## Local packs are staged inside the archive, so they can be renamed
+    ## into place.
+    staging = tempfile.mkdtemp(prefix='.alertwf-pack-', dir=None if s3 else src)
+    try:
+        n = 0
+        for base in (args.station or list_stations(src, s3)):
+            n += pack_station(src, base, args.before, staging, s3)
+        print('Packed', n, 'frames')
+    finally:
+        shutil.rmtree(staging)
@@ -1,23 +1,69 @@
 #!/usr/bin/env python3
 
 import boto3 # type: ignore
-import io, json, os, shutil, subprocess, time
+import hashlib, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
-from tools.imgtools import get_exif, get_timestamp
-from tools.alertwf import get_station_list, get_all_cameras, get_latest_image
+from tools.camlog import CameraLog, load_camera_state, to_jsonl
+from tools.manifest import Manifest
+from tools.metrics import Metrics
+from tools.packarchive import PackWriter
+from tools.prefilter import get_scorer
+from tools.uploader import Uploader
+from tools.imgtools import get_exif_from_bytes, get_timestamp, make_thumbnail, \
+    block_signature, block_change
+from tools.alertwf import get_station_list, get_all_cameras, fetch_latest_image, \
+    get_session, forget_image
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 class ImageScraper():
     def __init__(self, stations: List[str], destdir: str, \
                 tmpdir: Optional[str]='/tmp', \
-                loglevel: Optional[str]='normal') -> None:
+                loglevel: Optional[str]='normal', \
+                concurrency: Optional[int]=1, \
+                manifest: Optional[str]=None, \
+                max_delay: Optional[float]=None, \
+                dedup: Optional[str]='off', \
+                dedup_level: Optional[float]=6.0, \
+                upload_workers: Optional[int]=4, \
+                upload_queue: Optional[int]=256, \
+                archive: Optional[str]='frames', \
+                prefilter: Optional[str]=None, \
+                threshold: Optional[float]=3.0, \
+                metrics_log: Optional[str]=None, \
+                metrics_port: Optional[int]=None) -> None:
         self.dest = destdir
         self.tmpdir = tmpdir
         self.quiet = loglevel in ('quiet','silent')
         self.silent = loglevel == 'silent'
 
+        ## Stations are captured on a pool of `concurrency` threads. Downloads
+        ## and uploads are I/O bound and may all run at once, but exif parsing
+        ## and resizing are capped at the number of cores.
+        self.concurrency = max(1, concurrency)
+        self.limits = dict(
+            fetch=threading.Semaphore(self.concurrency),
+            process=threading.Semaphore(min(self.concurrency, os.cpu_count() or 1)),
+            store=threading.Semaphore(self.concurrency))
+        self.sweep_time = 0.0
+        get_session(maxsize=self.concurrency)
+        self.manifest = Manifest(manifest) if manifest else None
+        self.log_metadata = True
+
+        ## Near-duplicate frames (no cell of a 32x32 grid changing in
+        ## brightness by more than `dedup_level` since the station's previous
+        ## distinct frame) are either stored and flagged in the manifest (or
+        ## the pack index), or dropped. If `max_delay` is set, each station's polling interval
+        ## backs off towards it while the scene is static, and resets
+        ## towards the base delay when it changes.
+        assert dedup in ('off', 'flag', 'drop')
+        self.dedup = dedup
+        self.dedup_level = dedup_level
+        self.delay = 0.0
+        self.max_delay = max_delay
+
         self.save_to_s3 = self.dest.startswith('s3://')
         if self.save_to_s3:
             self.s3 = boto3.client('s3')
@@ -26,26 +72,69 @@ class ImageScraper():
                 key = key[:-1]
             self.bucket = bucket
             self.basekey = key
+            ## State kept in tmpdir for an S3 destination goes in a
+            ## directory of its own, so scrapers writing to other buckets
+            ## or prefixes never pick it up.
+            dest_hash = hashlib.sha1(f'{bucket}/{key}'.encode()).hexdigest()[:12]
+            self.workdir = os.path.join(tmpdir, f'alertwf-{dest_hash}')
+            ## Uploads that can't be completed are spilled to the workdir and
+            ## replayed once S3 is reachable again, when their manifest
+            ## rows are added.
+            self.uploader = Uploader(self.s3, bucket, os.path.join(self.workdir, 'spill'),
+                                     workers=upload_workers, maxsize=upload_queue,
+                                     on_replayed=self.record_frame)
         else:
             self.mddir = os.path.join(self.dest, 'metadata')
-            if not os.path.exists(self.mddir):
-                os.makedirs(self.mddir)
+            os.makedirs(self.mddir, exist_ok=True)
             assert os.path.isdir(self.mddir)
 
-        _t0 = datetime.fromisoformat('1970-01-01T00:00:00+00:00')
-        self.stations = dict()
-        for st in stations:
-            base = st.split('-',1)[-1]
-            tmppath = os.path.join(tmpdir, base+'.jpg')
-            self.stations[st] = dict(i=0, base=base, tmp=tmppath, last=_t0)
+        ## Camera metadata changes are logged relative to the last state
+        ## recorded, including by earlier runs: the local log itself, or for
+        ## S3 a snapshot kept in the workdir.
+        if self.save_to_s3:
+            self.camera_state = os.path.join(self.workdir, 'cameras.jsonl')
+        else:
+            self.camera_state = os.path.join(self.mddir, 'cameras.jsonl')
+        self.camlog = CameraLog()
+        if os.path.exists(self.camera_state):
+            try:
+                self.camlog = CameraLog(load_camera_state([self.camera_state]))
+            except ValueError:
+                pass
+
+        ## In 'packed' mode, frames are appended to daily per-station packs
+        ## (see tools/packarchive.py) instead of stored as separate objects,
+        ## and listed in the packs' indexes rather than the manifest.
+        assert archive in ('frames', 'packed')
+        assert archive != 'packed' or self.manifest is None
+        self.packer = None
+        if archive == 'packed':
+            if self.save_to_s3:
+                self.packer = PackWriter(os.path.join(self.workdir, 'packs'), self.upload_pack)
+                self.packer.sync(self.packs_before())
+            else:
+                self.packer = PackWriter(self.dest)
 
-            if not self.save_to_s3:
-                dest = os.path.join(self.dest, base)
-                if not os.path.exists(dest):
-                    os.makedirs(dest)
-                assert os.path.isdir(dest)
+        ## With a prefilter, each new frame's thumbnail is scored (see
+        ## tools/prefilter.py), and the full resolution image is only
+        ## stored when the score reaches `threshold`.
+        self.scorer = get_scorer(prefilter) if prefilter else None
+        self.threshold = threshold
 
-        if not self.quiet:
+        self.stations = dict()
+        for st in stations:
+            self.add_station(st)
+        self.stop_event = threading.Event()
+
+        ## Per-stage timings, byte counts and errors are kept in `metrics`
+        ## (see tools/metrics.py), optionally logged as JSON lines and
+        ## served for Prometheus on `metrics_port`.
+        self.metrics = Metrics(metrics_log)
+        self.metrics.gauges.append(self.gauges)
+        if metrics_port:
+            self.metrics.serve(metrics_port)
+
+        if not self.quiet and stations:
             print('Image path example:\n')
             now = datetime.now().isoformat()
             base = self.stations[stations[0]]['base']
@@ -56,83 +145,293 @@ class ImageScraper():
             print('\nProgress:\n')
 
 
-    def capture(self) -> List[str]:
-        metadata = get_all_cameras()
-        metadata['latest'] = ''
-        metadata['exif'] = ''
-
-        write_md = False
-        msgs = []
-        for name in self.stations:
-            msg = ''
-            try:
-                st = self.stations[name]
-                base = st['base']
-
-                tmpimg = os.path.join(self.tmpdir, f'{base}.jpg')
-                tmpsmall = os.path.join(self.tmpdir, f'small-{base}.jpg')
-
-                get_latest_image(name, tmpimg)
-                subprocess.call(['convert', tmpimg, '-resize', '@250000', tmpsmall],
-                                stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-
-                exif = get_exif(tmpimg)
-                ts = get_timestamp(exif, method='exif')
-                if ts > st['last']:
-                    fname = f"{base}_{ts.isoformat()}.jpg"
-                    ## Format for resized image was originally:
-                    ## "{base}_{ts.isoformat()}-small.jpg"
-                    ## New format makes filtering S3 objects easier
-                    fnamesmall = f"small-{base}_{ts.isoformat()}.jpg"
-                    if self.save_to_s3:
-                        with open(tmpimg,'rb') as src:
-                            key = f"{self.basekey}/{base}/{fname}"
-                            self.s3.put_object(Bucket=self.bucket, Key=key, Body=src)
-                        with open(tmpsmall,'rb') as src:
-                            key = f"{self.basekey}/{base}/{fnamesmall}"
-                            self.s3.put_object(Bucket=self.bucket, Key=key, Body=src)
-                    else:
-                        shutil.move(tmpimg,   os.path.join(self.dest, base, fname))
-                        shutil.move(tmpsmall, os.path.join(self.dest, base, fnamesmall))
-
-                    write_md = True
-                    metadata.loc[name,'latest'] = ts
-                    metadata.loc[name,'exif'] = json.dumps(exif)
-                    self.stations[name]['i'] += 1
-                    self.stations[name]['last'] = ts
-
-                msg = '%04d '%self.stations[name]['i']
+    def add_station(self, name: str) -> None:
+        base = name.split('-',1)[-1]
+        _t0 = datetime.fromisoformat('1970-01-01T00:00:00+00:00')
+        self.stations[name] = dict(i=0, base=base, last=_t0, signature=None,
+                                   interval=None, next=0.0, added=datetime.now(timezone.utc))
+
+        if not self.save_to_s3:
+            dest = os.path.join(self.dest, base)
+            os.makedirs(dest, exist_ok=True)
+            assert os.path.isdir(dest)
+
+    def remove_station(self, name: str) -> None:
+        self.stations.pop(name, None)
+        forget_image(name)
+        if hasattr(self.scorer, 'forget'):
+            self.scorer.forget(name)
+
+    def stop(self, *args) -> None:
+        '''
+        Ask `run` to return after the current sweep. Usable as a signal handler.
+        '''
+        self.stop_event.set()
+
+    def location(self, base: str, fname: str) -> str:
+        if self.save_to_s3:
+            return f"{self.basekey}/{base}/{fname}"
+        return os.path.join(self.dest, base, fname)
+
+    def store(self, base: str, fname: str, data: bytes, \
+              meta: Optional[Dict]=None) -> str:
+        '''
+        Save one file under the destination folder for a station. S3
+        uploads happen in the background. If `meta` is given, the file is
+        recorded in the manifest with it once stored, even if the upload
+        is spilled and only replayed by a later run. Returns its key (or
+        local path).
+        '''
+        on_done = None
+        if self.manifest is not None and meta is not None:
+            on_done = lambda key, etag: self.record_frame(key, etag, meta)
+        if self.save_to_s3:
+            key = self.location(base, fname)
+            self.uploader.put(key, data, on_done, meta)
+            return key
+        else:
+            path = self.location(base, fname)
+            with open(path, 'wb') as dest:
+                dest.write(data)
+            if on_done is not None:
+                on_done(path, '"%s"'%hashlib.md5(data).hexdigest())
+            return path
+
+    def record_frame(self, key: str, etag: str, meta: Dict) -> None:
+        '''
+        Add a stored frame to the manifest, given the `meta` it was
+        stored with.
+        '''
+        if self.manifest is not None:
+            self.manifest.add(key, datetime.fromisoformat(meta['time_stamp']), meta['station'],
+                              small_key=meta.get('small_key'), size=meta.get('size'), etag=etag,
+                              duplicate=meta.get('duplicate', False), full=meta.get('full', True))
+
+    def upload_pack(self, base: str, fname: str, path: str, final: bool) -> None:
+        on_done = None
+        if final:
+            on_done = lambda key, etag: os.remove(path)
+        self.uploader.put_file(self.location(base, fname), path, on_done)
+
+    def packs_before(self) -> str:
+        '''
+        Date before which every station's day is over, whatever its time
+        zone: packs for earlier days are final.
+        '''
+        return (datetime.now(timezone.utc) - timedelta(days=1)).date().isoformat()
+
+    def reschedule(self, st: Dict, changed: bool, t0: float) -> None:
+        '''
+        Set when a station should next be polled, given whether its last
+        poll returned a changed scene.
+        '''
+        interval = st['interval'] or self.delay
+        if self.max_delay:
+            if changed:
+                interval = max(self.delay, interval / 2)
+            else:
+                interval = min(self.max_delay, interval * 1.5)
+        st['interval'] = interval
+        st['next'] = t0 + interval
+
+    def capture_station(self, name: str, t0: Optional[float]=None) \
+            -> Tuple[str, Optional[datetime], Optional[Dict]]:
+        '''
+        Fetch, resize, and store the latest frame for a single station.
+        Returns a progress message, plus the timestamp and exif data of
+        the frame if it was new. The station's next poll is scheduled
+        relative to `t0`, the start of the sweep.
+        '''
+        if t0 is None:
+            t0 = time.monotonic()
+        st = self.stations[name]
+        m = self.metrics
+        timings: Dict[str, float] = dict()
+        stage = 'fetch'
+        try:
+            base = st['base']
+
+            with self.limits['fetch'], m.timer(name, 'fetch', timings):
+                img = fetch_latest_image(name)
+            if img is None:
+                self.reschedule(st, False, t0)
+                m.inc('alertwf_frames_total', station=name, result='unchanged')
+                msg = '%04d '%st['i']
                 msg += name.ljust(30)[:30]
-                msg += ': ' + ts.isoformat()
-            except Exception as e:
-                msg = ('%04d Error (%s): '%(self.stations[name]['i'], name)) + str(e)
+                msg += ': ' + st['last'].isoformat() + ' (unchanged)'
+                return msg, None, None
+            m.add_bytes(name, 'fetch', len(img))
+
+            stage = 'exif'
+            with self.limits['process'], m.timer(name, 'exif', timings):
+                exif = get_exif_from_bytes(img)
+            ts = get_timestamp(exif, method='exif')
+            new = ts > st['last']
+            duplicate = False
+            full = True
+            if new:
+                with self.limits['process']:
+                    stage = 'resize'
+                    with m.timer(name, 'resize', timings):
+                        small = make_thumbnail(img, area=250000)
+                        if self.dedup != 'off':
+                            sig = block_signature(small)
+                            ## Compare against the last distinct frame, so that
+                            ## slow drift still registers as a change eventually.
+                            duplicate = st['signature'] is not None and \
+                                block_change(st['signature'], sig) <= self.dedup_level
+                            if not duplicate:
+                                st['signature'] = sig
+                    if self.scorer is not None and not (duplicate and self.dedup == 'drop'):
+                        stage = 'score'
+                        with m.timer(name, 'score', timings):
+                            full = self.scorer(name, small) >= self.threshold
+                if duplicate and self.dedup == 'drop':
+                    new = False
+                    st['last'] = ts
+            self.reschedule(st, new and not duplicate, t0)
+            if new:
+                fname = f"{base}_{ts.isoformat()}.jpg"
+                ## Format for resized image was originally:
+                ## "{base}_{ts.isoformat()}-small.jpg"
+                ## New format makes filtering S3 objects easier
+                fnamesmall = f"small-{base}_{ts.isoformat()}.jpg"
+                meta = dict(time_stamp=ts.isoformat(), station=name,
+                            small_key=self.location(base, fnamesmall), size=len(img),
+                            duplicate=duplicate)
+                stage = 'store'
+                with self.limits['store'], m.timer(name, 'store', timings):
+                    if self.packer is not None:
+                        self.packer.append(base, ts, img if full else b'', small, duplicate)
+                    else:
+                        ## Frames kept as thumbnails only are indexed by the
+                        ## thumbnail's key, so they can still be found and labelled.
+                        self.store(base, fnamesmall, small,
+                                   None if full else dict(meta, size=len(small), full=False))
+                        if full:
+                            self.store(base, fname, img, meta)
+                m.add_bytes(name, 'store', len(small) + (len(img) if full else 0))
+
+                st['i'] += 1
+                st['last'] = ts
+
+            result = 'duplicate' if duplicate else 'new' if new and full \
+                else 'thumbnail' if new else 'old'
+            m.inc('alertwf_frames_total', station=name, result=result)
+            m.log(event='frame', station=name, frame_time=ts, result=result, bytes=len(img),
+                  timings={k: round(v, 4) for k, v in timings.items()})
+
+            msg = '%04d '%st['i']
+            msg += name.ljust(30)[:30]
+            msg += ': ' + ts.isoformat()
+            if duplicate:
+                msg += ' (duplicate)'
+            elif not full:
+                msg += ' (thumbnail only)'
+            return msg, (ts if new else None), (exif if new else None)
+        except Exception as e:
+            ## Don't let a conditional request skip a frame that failed
+            ## partway through processing.
+            forget_image(name)
+            self.reschedule(st, False, t0)
+            m.error(name, stage, e)
+            msg = ('%04d Error (%s): '%(self.stations[name]['i'], name)) + str(e)
+            return msg, None, None
+
+    def gauges(self) -> List[Tuple[str, Dict, float]]:
+        '''
+        Current values for the metrics endpoint: how long ago each station
+        last produced a new frame (or was added, if none has been seen yet),
+        and the state of the upload queue.
+        '''
+        now = datetime.now(timezone.utc)
+        out = [('alertwf_station_staleness_seconds', dict(station=name),
+                (now - (st['last'] if st['last'].year > 1970 else st['added'])).total_seconds())
+               for name, st in list(self.stations.items())]
+        out += [('alertwf_stations', dict(), len(self.stations))]
+        if self.save_to_s3:
+            out += [(f'alertwf_upload_{k}', dict(), v) for k, v in self.uploader.metrics().items()]
+        return out
+
+    def log_cameras(self) -> List[str]:
+        '''
+        Record cameras whose metadata changed since the last sweep; see
+        tools/camlog.py for rebuilding the full state.
+        '''
+        try:
+            now = datetime.now().astimezone()
+            changes = self.camlog.update(get_all_cameras(), now)
+            if changes:
+                if self.save_to_s3:
+                    key = f"{self.basekey}/metadata/cameras_{now.isoformat()}.jsonl"
+                    self.uploader.put(key, changes.encode())
+                    with open(self.camera_state + '.tmp', 'w') as snapshot:
+                        snapshot.write(to_jsonl(self.camlog.state, now))
+                    os.replace(self.camera_state + '.tmp', self.camera_state)
+                else:
+                    with open(self.camera_state, 'a') as log:
+                        log.write(changes)
+        except Exception as e:
+            self.metrics.error('metadata', 'metadata', e)
+            return ['Error (metadata): ' + str(e)]
+        return []
 
-            msgs.append(msg)
+    def capture(self) -> List[str]:
+        ## Every station polled in this sweep is rescheduled from its start,
+        ## not from when its own capture finished, so stations due together
+        ## stay due together in the next sweep.
+        t0 = time.monotonic()
+        names = [name for name, st in self.stations.items() if st['next'] <= t0]
+        if self.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                results = list(pool.map(lambda name: self.capture_station(name, t0), names))
+        else:
+            results = [self.capture_station(name, t0) for name in names]
+        msgs = [msg for msg, _, _ in results]
 
-        if write_md:
-            now = datetime.now().isoformat()
-            metadata = metadata[metadata.latest != '']
-            if self.save_to_s3:
-                bio = io.BytesIO()
-                metadata.to_csv(bio)
-                key = f"{self.basekey}/metadata/cameras_{now}.csv"
-                self.s3.put_object(Bucket=self.bucket, Key=key, Body=bio.getvalue())
-            else:
-                metadata.to_csv(f"{self.mddir}/cameras_{now}.csv")
+        if self.log_metadata:
+            msgs += self.log_cameras()
+        if self.save_to_s3:
+            self.uploader.replay_spill()
 
+        self.sweep_time = time.monotonic() - t0
+        self.metrics.sweep(self.sweep_time, self.delay, len(names),
+                           sum(msg.startswith('Error') or ' Error (' in msg for msg in msgs))
         return msgs
 
+    def next_due(self) -> float:
+        '''
+        Seconds until the next station is due to be polled.
+        '''
+        if not self.stations:
+            return self.delay
+        due = min(st['next'] for st in self.stations.values())
+        return max(0, due - time.monotonic())
+
     def run(self, delay: float, limit: Optional[int]=None):
+        self.delay = delay
         i = 0
-        while not os.path.exists('terminate'):
+        while not self.stop_event.is_set():
             i += 1
             msgs = self.capture()
 
+            ## Poll on a fixed schedule: the time spent capturing counts
+            ## against the delay, so report when a sweep overruns it.
+            sweep = '%05d Sweep: %.1fs / %.1fs'%(i, self.sweep_time, delay)
+            if self.sweep_time > delay:
+                sweep += ' (overrun)'
+            if self.save_to_s3:
+                up = self.uploader.metrics()
+                sweep += ' Uploads: %d queued, %d spilled, p95 %.2fs'%(
+                    up['queue_depth'], up['spilled'], up['latency_p95'])
+            msgs.append(sweep)
+
             if not self.silent:
                 if self.quiet:
                     now = datetime.now(tz=timezone(timedelta(hours=-7)))
-                    next = now + timedelta(seconds=delay)
-                    print('%05d'%i, 'Last:',now.ctime(), 'Next:', next.ctime(), end='\r')
+                    next = now + timedelta(seconds=self.next_due())
+                    print('%05d'%i, 'Last:',now.ctime(), 'Next:', next.ctime(),
+                          'Sweep: %.1fs'%self.sweep_time, end='\r')
                 else:
                     for msg in msgs:
                         term = 80
@@ -140,23 +439,39 @@ class ImageScraper():
                         if len(msg) > term:
                             msg = msg[:term-3]+'...'
                         print(msg)
-                    os.write(1, b"\x1b[%dF"%len(msgs))
+                    ## Rewrite the same lines next time, unless the output is
+                    ## going to a log rather than a terminal.
+                    if sys.stdout.isatty():
+                        os.write(1, b"\x1b[%dF"%len(msgs))
 
             if limit is None or i < limit:
-                time.sleep(delay)
+                self.stop_event.wait(self.next_due())
             else:
                 break
 
         if not self.silent:
-            print('\n'*(0 if self.quiet else len(self.stations)))
+            print('\n'*(0 if self.quiet else len(self.stations)+1))
 
-        if os.path.exists('terminate'):
+        self.close()
+
+    def close(self) -> None:
+        '''
+        Flush staged packs and wait (briefly) for pending uploads.
+        '''
+        if self.save_to_s3:
+            if self.packer is not None:
+                self.packer.sync(self.packs_before())
+            ## Don't hold up shutdown through an S3 outage: whatever
+            ## isn't uploaded by then is spilled for the next run.
+            self.uploader.close(timeout=30)
+        self.metrics.close()
+
+        if self.stop_event.is_set() and not self.silent:
             print('Terminated upon request')
-            os.remove('terminate')
 
 
 if __name__ == '__main__':
-    import pathlib
+    import pathlib, signal
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
@@ -165,12 +480,48 @@ if __name__ == '__main__':
                             + 'Multiple station names may be specified, but at '
                             + 'least one is required.'))
     parser.add_argument('--delay', type=float, default=20,
-                        help='Seconds between attempts to poll for new imagery.')
+                        help=('Seconds between attempts to poll for new imagery. '
+                            + 'With --max-delay, this is the shortest interval.'))
+    parser.add_argument('--max-delay', type=float, default=None,
+                        help=('Back off polling of static or offline stations, '
+                            + 'up to this many seconds between attempts.'))
+    parser.add_argument('--dedup', choices=['off', 'flag', 'drop'], default='off',
+                        help=('Flag frames nearly identical to the previous one in the '
+                            + '--manifest (or pack index), or drop them. A change covering less than a '
+                            + 'cell of a 32x32 grid, such as a faint, distant smoke '
+                            + 'plume, may go unnoticed, so only use "drop" where losing '
+                            + 'such frames is acceptable.'))
+    parser.add_argument('--dedup-level', type=float, default=6.0,
+                        help=('Largest change in brightness (0-255) of any grid cell '
+                            + 'for which a frame is still a duplicate.'))
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of stations to capture in parallel.')
     parser.add_argument('--limit', type=int, default=None,
                         help='Maximum number of polling attempts.')
     parser.add_argument('--tmpdir', type=pathlib.Path, default='/tmp',
-                        help=('Local directory in which to store downloaded images '
-                            + 'before transferring them to the destination.'))
+                        help=('Local directory in which to spill uploads that '
+                            + 'could not reach S3, until they can be retried, and '
+                            + 'to keep staged packs and the last camera state, in a '
+                            + 'subdirectory per S3 destination.'))
+    parser.add_argument('--upload-workers', type=int, default=4,
+                        help='Number of concurrent S3 uploads.')
+    parser.add_argument('--upload-queue', type=int, default=256,
+                        help='Maximum number of uploads waiting in memory.')
+    parser.add_argument('--manifest', default=None,
+                        help='SQLite manifest to record each archived frame in.')
+    parser.add_argument('--archive', choices=['frames', 'packed'], default='frames',
+                        help=('Store each frame as its own file, or pack them into '
+                            + 'one file per station per day.'))
+    parser.add_argument('--prefilter', default=None,
+                        help=('Score each new frame with this scorer (e.g. "anomaly", or '
+                            + 'module:attribute), and store only the resized copy of '
+                            + 'frames scoring below --threshold.'))
+    parser.add_argument('--threshold', type=float, default=3.0,
+                        help='Prefilter score at or above which full resolution frames are stored.')
+    parser.add_argument('--metrics-log', default=None,
+                        help='Append structured events (frames, errors, sweeps) to this JSON lines file.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics over HTTP on this port.')
     parser.add_argument('--quiet', action='store_true', help='Suppress (most) output')
     parser.add_argument('--silent', action='store_true', help='Suppress all output')
     parser.add_argument('dest', metavar='destination',
@@ -178,6 +529,11 @@ if __name__ == '__main__':
                             + 'relative to this directory in subfolders named '
                             + 'after each station.'))
     args = parser.parse_args()
+    if args.archive == 'packed' and args.manifest:
+        parser.error('--archive packed lists frames in the pack indexes, not --manifest')
+    if args.dedup == 'flag' and not args.manifest and args.archive != 'packed':
+        parser.error('--dedup flag records duplicates in the manifest, so needs --manifest '
+                     + '(or --archive packed)')
 
     if args.dest.startswith('s3://'):
         dest = args.dest
@@ -203,10 +559,16 @@ if __name__ == '__main__':
         print(f'''
         Scraping imagery for stations: {", ".join(stations)}
         Polling every: {delay} seconds
+        Concurrency: {args.concurrency}
         Saving to base path: {dest}
         '''.replace('        ','    '))
 
-    sc = ImageScraper(stations, dest, tmpdir, loglevel)
+    sc = ImageScraper(stations, dest, tmpdir, loglevel, args.concurrency, args.manifest,
+                      args.max_delay, args.dedup, args.dedup_level,
+                      args.upload_workers, args.upload_queue, args.archive,
+                      args.prefilter, args.threshold, args.metrics_log, args.metrics_port)
+    signal.signal(signal.SIGTERM, sc.stop)
+    signal.signal(signal.SIGINT, sc.stop)
     sc.run(delay, limit)
     if loglevel == 'normal':
         print('\n'*len(stations))
@@ -0,0 +1,58 @@
+import itertools, time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('PIL')
+pytest.importorskip('pandas')
+pytest.importorskip('requests')
+
+import scraper
+
+STATIONS = [f'Axis-Test{i:02d}' for i in range(20)]
+
+@pytest.fixture
+def fake_cameras(monkeypatch):
+    '''
+    Stations that return a new frame on every poll, after a short delay,
+    so captures within a sweep finish at different times.
+    '''
+    start = datetime(2024, 7, 1, 12, tzinfo=timezone(timedelta(hours=-7)))
+    counter = itertools.count()
+
+    def fetch(name):
+        time.sleep(0.005)
+        return b'frame %d' % next(counter)
+
+    monkeypatch.setattr(scraper, 'fetch_latest_image', fetch)
+    monkeypatch.setattr(scraper, 'get_exif_from_bytes', lambda img: dict(n=int(img.split()[1])))
+    monkeypatch.setattr(scraper, 'get_timestamp',
+                        lambda exif, method: start + timedelta(seconds=exif['n']))
+    monkeypatch.setattr(scraper, 'make_thumbnail', lambda img, area: img)
+
+def sweep_counts(sc, delay, sweeps):
+    polled = []
+    record = sc.metrics.sweep
+    def sweep(duration, delay, n, errors):
+        polled.append(n)
+        record(duration, delay, n, errors)
+    sc.metrics.sweep = sweep
+    sc.run(delay, sweeps)
+    return polled
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_every_station_polled_each_sweep(tmp_path, fake_cameras, concurrency):
+    sc = scraper.ImageScraper(STATIONS, str(tmp_path), str(tmp_path), 'silent', concurrency)
+    sc.log_metadata = False
+    assert sweep_counts(sc, 0.2, 3) == [20, 20, 20]
+    assert all(st['i'] == 3 for st in sc.stations.values())
+
+def test_backed_off_stations_polled_together(tmp_path, fake_cameras, monkeypatch):
+    monkeypatch.setattr(scraper, 'block_signature', lambda small: bytes(16))
+    sc = scraper.ImageScraper(STATIONS, str(tmp_path), str(tmp_path), 'silent',
+                              max_delay=1.0, dedup='drop')
+    sc.log_metadata = False
+    ## Every frame after the first is a duplicate, so all stations back
+    ## off by the same factor and stay in step.
+    assert sweep_counts(sc, 0.1, 3) == [20, 20, 20]
@@ -0,0 +1,65 @@
+import os, threading, time
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from tools.uploader import Uploader
+
+class FakeS3():
+    '''
+    Stores objects in a dict, or fails every request while `down`.
+    '''
+    def __init__(self, down=False):
+        self.down = down
+        self.objects = dict()
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        if self.down:
+            raise ConnectionError('S3 is down')
+        with self.lock:
+            self.objects[Key] = Body
+        return dict(ETag='"%d"' % len(Body))
+
+    def upload_file(self, path, bucket, key, Config=None):
+        if self.down:
+            raise ConnectionError('S3 is down')
+        with open(path, 'rb') as src, self.lock:
+            self.objects[key] = src.read()
+
+def test_spill_and_replay(tmp_path):
+    s3 = FakeS3(down=True)
+    up = Uploader(s3, 'bucket', str(tmp_path), workers=1, retries=2, backoff=0.01)
+    done = []
+    up.put('cams/A/A_1.jpg', b'frame', lambda key, etag: done.append(key), dict(station='A'))
+    up.close(timeout=5)
+    assert done == [] and s3.objects == {}
+    assert sorted(os.listdir(tmp_path)) == ['cams%2FA%2FA_1.jpg.meta', 'cams%2FA%2FA_1.jpg.spill']
+
+    ## A new run replays the spill once S3 is back, with the meta it was stored with.
+    s3.down = False
+    replayed = []
+    up = Uploader(s3, 'bucket', str(tmp_path), workers=1,
+                  on_replayed=lambda key, etag, meta: replayed.append((key, etag, meta)))
+    up.close(timeout=5)
+    assert s3.objects == {'cams/A/A_1.jpg': b'frame'}
+    assert replayed == [('cams/A/A_1.jpg', '"5"', dict(station='A'))]
+    assert os.listdir(tmp_path) == []
+    assert up.metrics()['replayed'] == 1
+
+def test_close_during_outage(tmp_path):
+    s3 = FakeS3(down=True)
+    up = Uploader(s3, 'bucket', str(tmp_path / 'spill'), workers=1, maxsize=1, backoff=60)
+    t0 = time.time()
+    for i in range(3):
+        up.put(f'k{i}', b'x')
+    ## Files have a queue of their own, so this doesn't wait for the full one.
+    (tmp_path / 'pack').write_bytes(b'pack')
+    up.put_file('pack', str(tmp_path / 'pack'))
+    assert time.time() - t0 < 1
+    up.close(timeout=0.5)
+    assert time.time() - t0 < 5
+    ## Everything is spilled (or, for files, left in place) without waiting out the retries.
+    assert sorted(os.listdir(tmp_path / 'spill')) == ['k0.spill', 'k1.spill', 'k2.spill']
+    assert (tmp_path / 'pack').exists()
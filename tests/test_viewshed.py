@@ -0,0 +1,25 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from tools.viewshed import ViewshedIndex
+
+def make_index():
+    ## A narrow wedge looking due east.
+    cameras = pd.DataFrame(dict(longitude=[-121.0], latitude=[45.2], elevation_km=[1.0],
+                                fov_lft=[89.0], fov_rt=[91.0]), index=['Axis-X'])
+    index = ViewshedIndex()
+    index.update(cameras)
+    return index
+
+def test_bbox_crossed_between_corners():
+    index = make_index()
+    assert index.point(-120.7, 45.2) == ['Axis-X']
+    ## The wedge crosses both boxes without reaching any of their corners.
+    assert index.bbox(-120.8, 45.0, -120.6, 45.3) == ['Axis-X']
+    assert index.bbox(-120.8, 45.01, -120.6, 45.21) == ['Axis-X']
+
+def test_bbox_outside_wedge():
+    index = make_index()
+    assert index.bbox(-120.8, 45.25, -120.6, 45.3) == []
+    assert index.bbox(-121.3, 45.0, -121.1, 45.3) == []
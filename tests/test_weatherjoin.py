@@ -0,0 +1,31 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from tools.weatherjoin import asof_join, image_times_utc
+
+def make_images():
+    paths = pd.Series(['AlertWildfire/Alpine/Alpine_2024-07-01T05:10:00-07:00.jpg',
+                       'AlertWildfire/Alpine/Alpine_2024-07-01T05:55:00-07:00.jpg',
+                       'AlertWildfire/Brightwood/Brightwood_2024-07-01T09:00:00-07:00.jpg'])
+    return pd.DataFrame(dict(id=[1, 2, 3], station=['Axis-Alpine', 'Axis-Alpine', 'Axis-Brightwood'],
+                             path=paths, utc=image_times_utc(paths)))
+
+def test_empty_weather():
+    ## As read from a query that returned no rows: every column is object.
+    weather = pd.DataFrame(columns=['id', 'station', 'time_stamp'])
+    joined = asof_join(make_images(), weather)
+    assert len(joined) == 0
+    assert {'image_id', 'weather_id', 'dt_seconds'} <= set(joined.columns)
+
+def test_key_resolutions_differ():
+    images = make_images()
+    images['utc'] = images['utc'].astype('datetime64[ns]')
+    weather = pd.DataFrame(dict(
+        id=[10, 11, 12],
+        station=['Axis-Alpine', 'Axis-Alpine', 'Axis-Brightwood'],
+        time_stamp=pd.to_datetime(['2024-07-01T12:00', '2024-07-01T13:00', '2024-07-01T20:00'])
+                     .astype('datetime64[us]')))
+    joined = asof_join(images, weather).set_index('image_id')
+    assert joined['weather_id'].to_dict() == {1: 10, 2: 11}
+    assert joined.loc[2, 'dt_seconds'] == 300
@@ -1,38 +1,86 @@
-import requests, shutil
+import requests, threading, time
 from datetime import datetime
 import pandas as pd # type: ignore
-from typing import List, Dict, Any
+from requests.adapters import HTTPAdapter
+from typing import List, Dict, Any, Optional, Tuple
 
-def get_metadata() -> Dict[str, Any]:
-    URL = 'https://s3-us-west-2.amazonaws.com/alertwildfire-data-public/all_cameras-v2.json'
-    REF = 'https://www.alertwildfire.org'
+BASE_URL = 'https://s3-us-west-2.amazonaws.com/alertwildfire-data-public'
+REF = 'https://www.alertwildfire.org'
 
-    result = requests.get(URL, headers={'referer': REF, 'origin': REF, 'connection': 'keep-alive'})
-    assert result.status_code == 200, ("Error requesting metadata: %d"%result.status_code)
-    return result.json()
+## A single pooled session is shared by every request to the bucket, so
+## connections are kept alive between polls instead of repeating the TLS
+## handshake for each image. `maxsize` bounds connections per host.
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+## Validators (ETag, Last-Modified) of the last image downloaded from
+## each URL, used to make conditional requests.
+_validators: Dict[str, Tuple[Optional[str], Optional[str]]] = dict()
+
+## The camera metadata changes far less often than it's requested, so the
+## last response (and the DataFrame parsed from it) is kept for `ttl`
+## seconds, and revalidated with a conditional request after that.
+METADATA_TTL = 60
+_metadata: Dict[str, Any] = dict(fetched=0.0, etag=None, data=None, cameras=None)
+_metadata_lock = threading.Lock()
+
+def get_session(maxsize: Optional[int]=None) -> requests.Session:
+    '''
+    Return the shared HTTP session, creating it on first use. Passing
+    `maxsize` resizes the per-host connection pool.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers.update({'referer': REF, 'origin': REF, 'connection': 'keep-alive'})
+            maxsize = maxsize or 10
+        if maxsize:
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxsize)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+def get_metadata(ttl: Optional[float]=METADATA_TTL) -> Dict[str, Any]:
+    URL = f'{BASE_URL}/all_cameras-v2.json'
+
+    with _metadata_lock:
+        if _metadata['data'] is not None and time.time() - _metadata['fetched'] < ttl:
+            return _metadata['data']
+
+        hdrs = {'cache-control': 'no-cache'}
+        if _metadata['etag'] and _metadata['data'] is not None:
+            hdrs['if-none-match'] = _metadata['etag']
+        result = get_session().get(URL, headers=hdrs)
+        _metadata['fetched'] = time.time()
+        if result.status_code == 304:
+            return _metadata['data']
+
+        assert result.status_code == 200, ("Error requesting metadata: %d"%result.status_code)
+        _metadata.update(etag=result.headers.get('etag'), data=result.json(), cameras=None)
+        return _metadata['data']
 
 def get_station_list() -> List[str]:
     data = get_metadata()
     return [station['properties']['id'] for station in data['features']]
 
-def get_all_cameras() -> object:
+def parse_cameras(data: Dict[str, Any], now: Optional[datetime]=None) -> object:
     '''
-    Fetch metadata for all cameras.
+    Convert the raw camera metadata into a DataFrame indexed by station id.
+    `lastupdate` is reported as seconds before `now`.
     '''
-    data = get_metadata()
     cameras = pd.json_normalize(data['features'])
     cameras.columns = [s.replace('properties.', '') for s in cameras.columns]
     cameras.set_index('id', inplace=True)
 
-    coords = pd.DataFrame(cameras['geometry.coordinates'].apply(pd.to_numeric).to_list(),
+    coords = pd.DataFrame(cameras['geometry.coordinates'].to_list(),
                           columns=['longitude','latitude','elevation_km'], index=cameras.index)
-    cameras = cameras.merge(coords, on='id')
-    cameras['fov_rt'] = cameras['fov_rt'].apply(pd.to_numeric)
-    cameras['fov_lft'] = cameras['fov_lft'].apply(pd.to_numeric)
-    cameras['fov_center'] = cameras['fov_center'].apply(pd.to_numeric)
-    cameras['last_movement_at'] = cameras['last_movement_at'].apply(pd.to_datetime)
-    now = datetime.now()
-    cameras['lastupdate'] = cameras['lastupdate'].apply(lambda dt: now - pd.to_timedelta(dt, unit='s'))
+    cameras = cameras.join(coords.apply(pd.to_numeric, errors='coerce'))
+    for col in ('fov_rt', 'fov_lft', 'fov_center'):
+        cameras[col] = pd.to_numeric(cameras[col], errors='coerce')
+    cameras['last_movement_at'] = pd.to_datetime(cameras['last_movement_at'], errors='coerce', utc=True)
+    now = now or datetime.now()
+    cameras['lastupdate'] = now - pd.to_timedelta(pd.to_numeric(cameras['lastupdate'], errors='coerce'), unit='s')
 
     drop_cols = ['type', 'attribution', 'sponsor', 'isp', 'network', 'county', \
                  'region', 'geometry.type', 'geometry.coordinates']
@@ -40,31 +88,71 @@ def get_all_cameras() -> object:
 
     return cameras
 
+def get_all_cameras(ttl: Optional[float]=METADATA_TTL) -> object:
+    '''
+    Fetch metadata for all cameras. The parsed table is cached along with
+    the response it came from, so callers get a copy they may modify.
+    '''
+    data = get_metadata(ttl)
+    with _metadata_lock:
+        if _metadata['cameras'] is None or _metadata['data'] is not data:
+            _metadata['cameras'] = parse_cameras(data, datetime.fromtimestamp(_metadata['fetched']))
+        return _metadata['cameras'].copy()
+
 #cameras = get_all_cameras()
 
-def get_latest_image(station_id: str, dest: str) -> None:
-    '''
-    Download latest image from a station and dump it in
-    its native jpg format directly to a file.
+def fetch_latest_image(station_id: str) -> Optional[bytes]:
     '''
-    assert dest.lower().endswith('.jpg')
+    Download latest image from a station into memory.
 
-    URL = f'https://s3-us-west-2.amazonaws.com/alertwildfire-data-public/{station_id}/latest_full.jpg'
-    URL += f'?x-request-time={int(datetime.now().timestamp())}'
+    Requests are conditional on the ETag/Last-Modified of the previous
+    download from the same station. Returns None if the server reports
+    the image has not changed.
+    '''
+    URL = f'{BASE_URL}/{station_id}/latest_full.jpg'
     hdrs = {
-        'referer':'https://www.alertwildfire.org',
-        'origin':'https://www.alertwildfire.org',
         'accept':'image/webp,*/*',
         'accept-language':'en,en-GB;q=0.5',
         'accept-encoding':'gzip, deflate',
+        'cache-control':'no-cache',
         'user-agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:86.0) Gecko/20100101 Firefox/86.0'
     }
-    result = requests.get(URL, headers=hdrs, stream=True)
+    etag, modified = _validators.get(URL, (None, None))
+    if etag:
+        hdrs['if-none-match'] = etag
+    if modified:
+        hdrs['if-modified-since'] = modified
+
+    result = get_session().get(URL, headers=hdrs)
+    if result.status_code == 304:
+        return None
 
     assert result.status_code == 200, ("Error requesting image: %d"%result.status_code)
 
+    _validators[URL] = (result.headers.get('etag'), result.headers.get('last-modified'))
+    return result.content
+
+def get_latest_image(station_id: str, dest: str) -> bool:
+    '''
+    Download latest image from a station and dump it in
+    its native jpg format directly to a file. Returns False, leaving
+    `dest` untouched, if the image has not changed since the last call.
+    '''
+    assert dest.lower().endswith('.jpg')
+
+    data = fetch_latest_image(station_id)
+    if data is None:
+        return False
+
     with open(dest,'wb') as latest_img:
-        result.raw.decode_content = True
-        shutil.copyfileobj(result.raw, latest_img)
+        latest_img.write(data)
+    return True
+
+def forget_image(station_id: str) -> None:
+    '''
+    Drop the cached validators for a station so that the next call to
+    get_latest_image downloads it unconditionally.
+    '''
+    _validators.pop(f'{BASE_URL}/{station_id}/latest_full.jpg', None)
 
 #get_latest_image('Axis-Brightwood', 'latest_axis.jpg')
\ No newline at end of file
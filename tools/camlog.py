@@ -0,0 +1,94 @@
+'''
+Append-only change log of camera metadata.
+
+Instead of snapshotting every camera on every poll, only the rows whose
+fields differ from the last recorded state are written, as JSON lines
+stamped with the time they were observed. `load_camera_state` replays
+the log to rebuild the table of all cameras as of any point in time,
+and a `CameraLog` seeded with the latest state carries on from where
+an earlier process left off.
+'''
+
+import io
+import pandas as pd # type: ignore
+from datetime import datetime
+from typing import Iterable, List, Optional, Union
+
+## Recomputed from the request time on every fetch, so it always changes
+IGNORE_COLS = ['lastupdate']
+
+def diff_cameras(prev: Optional[object], cur: object) -> object:
+    '''
+    Rows of `cur` that are new, or whose fields differ from `prev`.
+    '''
+    cols = [c for c in cur.columns if c not in IGNORE_COLS]
+    if prev is None or len(prev) == 0:
+        return cur[cols]
+    prev = prev.reindex(index=cur.index, columns=cols)
+    ## State read back from a log has dates as strings, and may have
+    ## numbers as objects.
+    for c in cols:
+        if prev[c].dtype != cur[c].dtype:
+            if pd.api.types.is_datetime64_any_dtype(cur[c]):
+                prev[c] = pd.to_datetime(prev[c], utc=True, errors='coerce')
+            elif pd.api.types.is_numeric_dtype(cur[c]):
+                prev[c] = pd.to_numeric(prev[c], errors='coerce')
+    a, b = cur[cols].astype(object), prev.astype(object)
+    changed = (a != b) & ~(a.isna() & b.isna())
+    return cur.loc[changed.any(axis=1), cols]
+
+def to_jsonl(changes: object, now: datetime) -> str:
+    '''
+    Serialize changed rows as JSON lines, one per camera.
+    '''
+    if len(changes) == 0:
+        return ''
+    rows = changes.reset_index()
+    rows.insert(0, 'time', now.isoformat())
+    return rows.to_json(orient='records', lines=True, date_format='iso',
+                        double_precision=15) + '\n'
+
+class CameraLog():
+    '''
+    Tracks the last recorded camera state and produces the log lines
+    needed to bring it up to date. Without a `state` (for instance from
+    `load_camera_state`), the first update records every camera.
+    '''
+    def __init__(self, state: Optional[object]=None) -> None:
+        self.state = state
+
+    def update(self, cameras: object, now: Optional[datetime]=None) -> str:
+        changes = diff_cameras(self.state, cameras)
+        if len(changes):
+            if self.state is None:
+                self.state = changes.copy()
+            else:
+                self.state = pd.concat([self.state.drop(changes.index, errors='ignore'), changes])
+        return to_jsonl(changes, now or datetime.now().astimezone())
+
+def read_log(sources: Iterable[Union[str, bytes]]) -> object:
+    '''
+    Read change log records from file paths or raw bytes.
+    '''
+    frames: List[object] = []
+    for src in sources:
+        if isinstance(src, bytes):
+            src = io.BytesIO(src)
+        frame = pd.read_json(src, orient='records', lines=True, convert_dates=False)
+        if len(frame):
+            frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=['time', 'id'])
+    log = pd.concat(frames, ignore_index=True)
+    log['time'] = pd.to_datetime(log['time'], utc=True)
+    return log.sort_values('time', kind='stable')
+
+def load_camera_state(sources: Iterable[Union[str, bytes]], at: Optional[datetime]=None) -> object:
+    '''
+    Rebuild the camera table as it was at time `at` (default: latest).
+    '''
+    log = read_log(sources)
+    if at is not None and len(log):
+        at = pd.Timestamp(at if at.tzinfo else at.astimezone()).tz_convert('UTC')
+        log = log[log['time'] <= at]
+    return log.groupby('id').tail(1).set_index('id').drop(columns='time', errors='ignore')
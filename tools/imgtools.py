@@ -1,13 +1,189 @@
-import json, subprocess
+import io, math, os, struct
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Any, Union
+from PIL import Image # type: ignore
+from typing import Dict, Any, BinaryIO, Iterable, List, Optional, Tuple, Union
+
+## Tags of interest, named as exiftool reports them. Anything else
+## found in the IFDs is ignored.
+EXIF_TAGS = {
+    0x010e: 'ImageDescription', 0x010f: 'Make', 0x0110: 'Model',
+    0x0112: 'Orientation', 0x011a: 'XResolution', 0x011b: 'YResolution',
+    0x0128: 'ResolutionUnit', 0x0131: 'Software', 0x0132: 'ModifyDate',
+    0x013b: 'Artist', 0x8298: 'Copyright', 0x829a: 'ExposureTime',
+    0x829d: 'FNumber', 0x8827: 'ISO', 0x882a: 'TimeZoneOffset',
+    0x9003: 'DateTimeOriginal', 0x9004: 'CreateDate', 0x9010: 'OffsetTime',
+    0x9011: 'OffsetTimeOriginal', 0x9012: 'OffsetTimeDigitized',
+    0xa001: 'ColorSpace', 0xa002: 'ExifImageWidth', 0xa003: 'ExifImageHeight',
+}
+EXIF_IFD_POINTER = 0x8769
+
+## TIFF field type -> (struct format, size in bytes)
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('L', 4), 5: ('LL', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('l', 4), 10: ('ll', 8),
+}
+
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+def _read_segments(src: BinaryIO) -> Dict[str, Any]:
+    '''
+    Walk the JPEG marker segments up to the start of scan, returning the
+    APP1 Exif payload and frame dimensions. Scan data is never read.
+    '''
+    out: Dict[str, Any] = dict()
+    assert src.read(2) == b'\xff\xd8', 'Not a JPEG file'
+    while True:
+        hdr = src.read(4)
+        if len(hdr) < 4 or hdr[0] != 0xff:
+            break
+        marker = hdr[1]
+        if marker == 0xff:
+            ## Fill byte; resynchronize one byte on.
+            src.seek(-3, io.SEEK_CUR)
+            continue
+        length = struct.unpack('>H', hdr[2:])[0]
+        if marker == 0xda:
+            break
+        if marker == 0xe1 and 'app1' not in out:
+            data = src.read(length-2)
+            if data.startswith(b'Exif\x00\x00'):
+                out['app1'] = data[6:]
+            continue
+        if marker in SOF_MARKERS:
+            data = src.read(length-2)
+            out['ImageHeight'], out['ImageWidth'] = struct.unpack('>HH', data[1:5])
+            break
+        src.seek(length-2, io.SEEK_CUR)
+    return out
+
+def _parse_ifd(tiff: bytes, offset: int, endian: str, exif: Dict[str, Any]) -> None:
+    n = struct.unpack(endian+'H', tiff[offset:offset+2])[0]
+    for i in range(n):
+        entry = offset + 2 + 12*i
+        tag, typ, count = struct.unpack(endian+'HHL', tiff[entry:entry+8])
+        if tag == EXIF_IFD_POINTER:
+            sub = struct.unpack(endian+'L', tiff[entry+8:entry+12])[0]
+            _parse_ifd(tiff, sub, endian, exif)
+            continue
+        if tag not in EXIF_TAGS or typ not in TIFF_TYPES:
+            continue
+        fmt, size = TIFF_TYPES[typ]
+        nbytes = size*count
+        if nbytes <= 4:
+            raw = tiff[entry+8:entry+8+nbytes]
+        else:
+            ptr = struct.unpack(endian+'L', tiff[entry+8:entry+12])[0]
+            raw = tiff[ptr:ptr+nbytes]
+
+        if typ == 2:
+            value: Any = raw.split(b'\x00',1)[0].decode('ISO-8859-15').strip()
+        elif typ == 7:
+            value = raw.decode('ISO-8859-15').strip('\x00 ')
+        else:
+            values = struct.unpack(endian+fmt*count, raw)
+            if typ in (5, 10):
+                values = tuple(n/d if d else 0 for n, d in zip(values[::2], values[1::2]))
+            ## exiftool prints multi-valued numbers as a space separated
+            ## string, except TimeZoneOffset whose first value is the one
+            ## that applies to DateTimeOriginal.
+            if count == 1 or tag == 0x882a:
+                value = values[0]
+            else:
+                value = ' '.join(str(v) for v in values)
+        exif[EXIF_TAGS[tag]] = value
+
+def _fmt_filetime(ts: float) -> str:
+    dt = datetime.fromtimestamp(ts).astimezone()
+    tz = dt.strftime('%z')
+    return dt.strftime('%Y:%m:%d %H:%M:%S') + tz[:3] + ':' + tz[3:]
+
+def read_exif(src: BinaryIO) -> Dict[str, Any]:
+    '''
+    Parse exif data from a JPEG stream, reading only the header segments.
+    '''
+    segments = _read_segments(src)
+    exif: Dict[str, Any] = dict()
+    tiff = segments.get('app1')
+    if tiff:
+        endian = '<' if tiff[:2] == b'II' else '>'
+        ifd0 = struct.unpack(endian+'L', tiff[4:8])[0]
+        _parse_ifd(tiff, ifd0, endian, exif)
+    for key in ('ImageWidth', 'ImageHeight'):
+        if key in segments:
+            exif[key] = segments[key]
+    return exif
 
 def get_exif(fname: str) -> Dict[str, Any]:
-    sp = subprocess.Popen(f'/usr/local/bin/exiftool -json {fname}', shell=True, stdout=subprocess.PIPE)
-    result = sp.stdout.read().decode('ISO-8859-15')
-    exif = json.loads(result)[0]
+    '''
+    Read exif data from a JPEG file, in the same shape as the output of
+    `exiftool -json`, including the File* system tags.
+    '''
+    with open(fname, 'rb') as src:
+        exif = read_exif(src)
+    stat = os.stat(fname)
+    exif.update(SourceFile=fname, FileName=os.path.basename(fname),
+                Directory=os.path.dirname(fname), FileSize=stat.st_size,
+                FileModifyDate=_fmt_filetime(stat.st_mtime),
+                FileAccessDate=_fmt_filetime(stat.st_atime),
+                FileInodeChangeDate=_fmt_filetime(stat.st_ctime),
+                FileType='JPEG', MIMEType='image/jpeg')
+    return exif
+
+def get_exif_from_bytes(data: bytes, fname: Optional[str]=None) -> Dict[str, Any]:
+    '''
+    Read exif data from an in-memory JPEG. There is no file on disk, so
+    the File* dates are all set to the time of the call.
+    '''
+    exif = read_exif(io.BytesIO(data))
+    now = _fmt_filetime(datetime.now().timestamp())
+    exif.update(FileSize=len(data), FileModifyDate=now, FileAccessDate=now,
+                FileInodeChangeDate=now, FileType='JPEG', MIMEType='image/jpeg')
+    if fname:
+        exif.update(SourceFile=fname, FileName=os.path.basename(fname),
+                    Directory=os.path.dirname(fname))
     return exif
 
+def get_exif_batch(fnames: Iterable[str], workers: Optional[int]=8) -> List[Dict[str, Any]]:
+    '''
+    Read exif data from many files at once. Results are in the same order
+    as `fnames`; files that can't be parsed yield an empty dict.
+    '''
+    def _safe(fname: str) -> Dict[str, Any]:
+        try:
+            return get_exif(fname)
+        except Exception:
+            return dict()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_safe, fnames))
+
+_s3 = None
+
+def small_path(path: str) -> str:
+    '''
+    Path of the resized copy of an archived image. Frames kept as
+    thumbnails only are archived under that path already.
+    '''
+    head, fname = os.path.split(path)
+    if fname.startswith('small-'):
+        return path
+    return os.path.join(head, 'small-'+fname)
+
+def read_image(path: str, bucket: Optional[str]=None, local_root: Optional[str]=None) -> bytes:
+    '''
+    Read an archived image, either from a local copy of the archive or
+    from S3. The S3 client is created on first use in each process.
+    '''
+    global _s3
+    if local_root is not None:
+        with open(os.path.join(local_root, path), 'rb') as src:
+            return src.read()
+    if _s3 is None:
+        import boto3 # type: ignore
+        _s3 = boto3.client('s3')
+    return _s3.get_object(Bucket=bucket, Key=path)['Body'].read()
+
 def get_timestamp(src: Union[Dict,str], method='fname') -> datetime:
     exif = get_exif(src) if method == 'fname' else  src
     try:
@@ -15,4 +191,55 @@ def get_timestamp(src: Union[Dict,str], method='fname') -> datetime:
         timestamp = f"{exif['DateTimeOriginal']}{tzfmt(exif['TimeZoneOffset'])}:00"
     except:
         timestamp = exif['FileInodeChangeDate']
-    return datetime.strptime(timestamp, r'%Y:%m:%d %H:%M:%S%z')
\ No newline at end of file
+    return datetime.strptime(timestamp, r'%Y:%m:%d %H:%M:%S%z')
+
+def area_size(width: int, height: int, area: int) -> Tuple[int, int]:
+    '''
+    Output dimensions of ImageMagick's `-resize @area`: the largest size
+    with the same aspect ratio whose pixel count is at most `area`.
+    Images already within the area are left alone.
+    '''
+    if width*height <= area:
+        return width, height
+    scale = math.sqrt(area) / math.sqrt(width*height)
+    return max(1, int(width*scale)), max(1, int(height*scale))
+
+def make_thumbnail(data: bytes, area: Optional[int]=250000, quality: Optional[int]=92) -> bytes:
+    '''
+    Produce a resized copy of an in-memory JPEG, equivalent to
+    `convert src -resize @area dest`. The decoder is put in draft mode so
+    that the DCT downscales by a power of two before the final resample,
+    and the exif block is carried over to the thumbnail.
+    '''
+    img = Image.open(io.BytesIO(data))
+    size = area_size(img.width, img.height, area)
+    exif = img.info.get('exif')
+    img.draft('RGB', size)
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS)
+
+    out = io.BytesIO()
+    if exif:
+        img.save(out, format='JPEG', quality=quality, exif=exif)
+    else:
+        img.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+def block_signature(data: bytes, size: Optional[int]=32) -> bytes:
+    '''
+    Mean brightness of each cell of a size x size grid over a JPEG. Each
+    cell averages hundreds of pixels of a thumbnail, which evens out
+    compression noise but still registers a change in a small part of
+    the scene.
+    '''
+    img = Image.open(io.BytesIO(data))
+    img.draft('L', (4*size, 4*size))
+    return img.convert('L').resize((size, size), Image.BOX).tobytes()
+
+def block_change(a: bytes, b: bytes) -> float:
+    '''
+    Largest change in brightness (0-255) of any cell between two block
+    signatures, net of the change in overall brightness.
+    '''
+    shift = (sum(b) - sum(a)) / len(a)
+    return max(abs(y - x - shift) for x, y in zip(a, b))
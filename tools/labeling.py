@@ -0,0 +1,253 @@
+'''
+Backend for labeling images from the `images` table.
+
+`LabelSession` walks through a selection of images a page at a time,
+keeps display-sized thumbnails of the next few images decoded ahead of
+time in a small LRU cache, and buffers label changes, writing them to
+the `labels` table in batches. A front end (see tools/labelui.py) only
+needs `current`, `forward`, `back`, `image`, `labels` and `set_label`.
+'''
+
+import io, threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image # type: ignore
+import sqlalchemy as SQL # type: ignore
+from tools.imgtools import read_image, small_path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class PagedCursor():
+    '''
+    Images in (time_stamp, id) order, fetched `page_size` rows at a time
+    with keyset pagination, so each page is a range scan of the
+    `time_stamp_id` index (see CreateDBTables.sql) however far into the
+    selection it is. `where` is an extra SQL condition on
+    `im`, with its bound values in `params`.
+    '''
+    def __init__(self, conn, where: Optional[str]=None, params: Optional[Dict[str, Any]]=None, \
+                 page_size: Optional[int]=100) -> None:
+        self.conn = conn
+        self.where = where
+        self.params = params or dict()
+        self.page_size = page_size
+        self.rows: List[Dict[str, Any]] = []
+        self.done = False
+
+    def fetch_page(self) -> int:
+        conds = [self.where] if self.where else []
+        params = dict(self.params, n=self.page_size)
+        if self.rows:
+            conds.append('(im.time_stamp > :t OR (im.time_stamp = :t AND im.id > :id))')
+            params.update(t=self.rows[-1]['time_stamp'], id=self.rows[-1]['id'])
+        query = SQL.text('SELECT im.id, im.station, im.time_stamp, im.path FROM images im'
+                         + (' WHERE ' + ' AND '.join(f'({c})' for c in conds) if conds else '')
+                         + ' ORDER BY im.time_stamp, im.id LIMIT :n;')
+        page = [dict(id=r[0], station=r[1], time_stamp=r[2], path=r[3])
+                for r in self.conn.execute(query, **params).fetchall()]
+        if len(page) < self.page_size:
+            self.done = True
+        self.rows += page
+        return len(page)
+
+    def get(self, i: int) -> Optional[Dict[str, Any]]:
+        '''
+        The i-th selected row, fetching pages as needed.
+        '''
+        while i >= len(self.rows) and not self.done:
+            self.fetch_page()
+        return self.rows[i] if 0 <= i < len(self.rows) else None
+
+def make_display_image(data: bytes, width: int, quality: Optional[int]=85) -> bytes:
+    img = Image.open(io.BytesIO(data))
+    height = max(1, round(img.size[1] * width / img.size[0]))
+    img.draft('RGB', (width, height))
+    img = img.convert('RGB')
+    if img.size[0] > width:
+        img = img.resize((width, height), Image.BILINEAR)
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+class Prefetcher():
+    '''
+    LRU cache of display images keyed by image id, filled in the
+    background by `workers` threads. `load(row)` returns the encoded
+    image for a row.
+    '''
+    def __init__(self, load: Callable[[Dict[str, Any]], bytes], size: Optional[int]=64, \
+                 workers: Optional[int]=4) -> None:
+        self.load = load
+        self.size = size
+        self.lock = threading.Lock()
+        self.cache: 'OrderedDict[int, Future]' = OrderedDict()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def prefetch(self, row: Dict[str, Any]) -> Future:
+        with self.lock:
+            future = self.cache.get(row['id'])
+            if future is None:
+                future = self.pool.submit(self.load, row)
+                self.cache[row['id']] = future
+            self.cache.move_to_end(row['id'])
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        return future
+
+    def get(self, row: Dict[str, Any]) -> bytes:
+        future = self.prefetch(row)
+        try:
+            return future.result()
+        except Exception:
+            ## Don't keep failures cached; the next request retries.
+            with self.lock:
+                self.cache.pop(row['id'], None)
+            raise
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
+
+class LabelWriter():
+    '''
+    Buffer label changes and write them to the `labels` table in one
+    batch every `interval` seconds (and on `flush`/`close`). A value of
+    None removes the label.
+    '''
+    def __init__(self, engine, interval: Optional[float]=5.0) -> None:
+        self.engine = engine
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending: Dict[Tuple[int, str], Optional[int]] = dict()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set(self, image_id: int, label: str, value: Optional[int]) -> None:
+        with self.lock:
+            self.pending[(image_id, label)] = value
+
+    def flush(self) -> int:
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        if not pending:
+            return 0
+        upserts = [dict(image_id=i, label=l, value=v) for (i, l), v in pending.items() if v is not None]
+        deletes = [dict(image_id=i, label=l) for (i, l), v in pending.items() if v is None]
+        try:
+            with self.engine.begin() as conn:
+                if upserts:
+                    conn.execute(SQL.text('''
+                        INSERT INTO labels (image_id, label, value) VALUES (:image_id, :label, :value)
+                        ON DUPLICATE KEY UPDATE value = VALUES(value);'''), upserts)
+                if deletes:
+                    conn.execute(SQL.text(
+                        'DELETE FROM labels WHERE image_id = :image_id AND label = :label;'), deletes)
+        except Exception:
+            ## Put the batch back, unless a newer value was set meanwhile.
+            with self.lock:
+                pending.update(self.pending)
+                self.pending = pending
+            raise
+        return len(pending)
+
+    def _run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print('Error writing labels:', str(e))
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+
+class LabelSession():
+    '''
+    Navigate a selection of images and label them. Images are read from
+    `local_root` if given, otherwise from S3 `bucket`; the resized copies
+    are used unless `full` is set.
+    '''
+    def __init__(self, engine, where: Optional[str]=None, params: Optional[Dict[str, Any]]=None, \
+                 bucket: Optional[str]=None, local_root: Optional[str]=None, \
+                 full: Optional[bool]=False, width: Optional[int]=800, \
+                 ahead: Optional[int]=8, cache_size: Optional[int]=64, \
+                 page_size: Optional[int]=100, flush_interval: Optional[float]=5.0) -> None:
+        self.engine = engine
+        self.conn = engine.connect()
+        self.cursor = PagedCursor(self.conn, where, params, page_size)
+        self.bucket = bucket
+        self.local_root = local_root
+        self.full = full
+        self.width = width
+        self.ahead = ahead
+        self.prefetcher = Prefetcher(self._load, cache_size)
+        self.writer = LabelWriter(engine, flush_interval)
+        self.stored: Dict[int, Dict[str, int]] = dict()
+        self.pos = 0
+        self._prefetch()
+
+    def _load(self, row: Dict[str, Any]) -> bytes:
+        path = row['path'] if self.full else small_path(row['path'])
+        return make_display_image(read_image(path, self.bucket, self.local_root), self.width)
+
+    def _prefetch(self) -> None:
+        for i in range(self.pos, self.pos + self.ahead + 1):
+            row = self.cursor.get(i)
+            if row is None:
+                break
+            self.prefetcher.prefetch(row)
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        return self.cursor.get(self.pos)
+
+    def forward(self) -> bool:
+        if self.cursor.get(self.pos + 1) is None:
+            return False
+        self.pos += 1
+        self._prefetch()
+        return True
+
+    def back(self) -> bool:
+        if self.pos == 0:
+            return False
+        self.pos -= 1
+        return True
+
+    def image(self) -> bytes:
+        return self.prefetcher.get(self.current())
+
+    def _load_labels(self) -> None:
+        '''
+        Read stored labels for every loaded row that doesn't have them yet.
+        '''
+        ids = [r['id'] for r in self.cursor.rows if r['id'] not in self.stored]
+        if not ids:
+            return
+        query = SQL.text('SELECT image_id, label, value FROM labels WHERE image_id IN :ids') \
+                   .bindparams(SQL.bindparam('ids', expanding=True))
+        for i in ids:
+            self.stored[i] = dict()
+        for img_id, label, value in self.conn.execute(query, ids=ids):
+            self.stored[img_id][label] = value
+
+    def labels(self) -> Dict[str, int]:
+        '''
+        Labels of the current image, including unsaved changes.
+        '''
+        img_id = self.current()['id']
+        if img_id not in self.stored:
+            self._load_labels()
+        return self.stored[img_id]
+
+    def set_label(self, label: str, value: Optional[int]) -> None:
+        labels = self.labels()
+        if value is None:
+            labels.pop(label, None)
+        else:
+            labels[label] = value
+        self.writer.set(self.current()['id'], label, value)
+
+    def close(self) -> None:
+        self.writer.close()
+        self.prefetcher.close()
+        self.conn.close()
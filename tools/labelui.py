@@ -0,0 +1,64 @@
+'''
+Keyboard-driven labeling front end for Jupyter, reading everything from
+a `LabelSession` (tools/labeling.py).
+
+    ui = LabelUI(session, ['smoke', 'MotionBlur', 'Obscured'])
+    ui.show()
+
+Keys: left/up go back, right/down/Enter go forward, digit N marks the
+N-th label as 1 (with Ctrl as 0), and 0 clears the current image's
+labels. Call `session.close()` when done to write any pending labels.
+'''
+
+import ipywidgets as widgets # type: ignore
+from ipyevents import Event # type: ignore
+from IPython.display import display # type: ignore
+from tools.labeling import LabelSession
+from typing import List
+
+class LabelUI():
+    def __init__(self, session: LabelSession, fields: List[str]) -> None:
+        self.session = session
+        self.fields = fields
+        self.image = widgets.Image(format='jpeg', width=session.width)
+        self.info = widgets.HTML('')
+        self.events = Event(source=self.image, watched_events=['keydown'])
+        self.events.on_dom_event(self.handle_event)
+        self.update(image=True)
+
+    def update(self, image: bool=False) -> None:
+        row = self.session.current()
+        if row is None:
+            self.info.value = 'No images selected'
+            return
+        if image:
+            try:
+                self.image.value = self.session.image()
+            except Exception as e:
+                self.image.value = b''
+                self.info.value = f'Error reading {row["path"]}: {e}'
+                return
+        labels = self.session.labels()
+        c = lambda tag: {None: 'gray', 1: 'green', 0: 'red'}.get(tag, 'gray')
+        cols = [f"<td style='background-color:{c(labels.get(f))}'>{i+1} {f}</td>"
+                for i, f in enumerate(self.fields)]
+        self.info.value = (f"<table><tr>{''.join(cols)}</tr></table>"
+                           + f"{row['station']} {row['time_stamp']} ({self.session.pos+1})")
+
+    def handle_event(self, evt) -> None:
+        key = evt.get('key', '')
+        moved = False
+        if evt['code'] in ['ArrowUp', 'ArrowLeft']:
+            moved = self.session.back()
+        elif evt['code'] in ['ArrowDown', 'ArrowRight'] or key == 'Enter':
+            ## Picks up 'NumpadEnter' as well
+            moved = self.session.forward()
+        elif key == '0':
+            for f in self.fields:
+                self.session.set_label(f, None)
+        elif key.isdigit() and int(key) <= len(self.fields):
+            self.session.set_label(self.fields[int(key)-1], 0 if evt['ctrlKey'] else 1)
+        self.update(image=moved)
+
+    def show(self) -> None:
+        display(self.image, self.info)
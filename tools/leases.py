@@ -0,0 +1,110 @@
+'''
+Station leases in a shared directory, used to split stations between
+scraper workers that may be running on different hosts.
+
+Each worker touches a heartbeat file under `workers/` and holds one file
+per station under `stations/`. Leases are renewed by touching them, and
+any lease (or worker) not touched within `ttl` seconds is considered
+dead, so its stations are picked up by the survivors. Claims rely only
+on O_EXCL creation and rename, so the directory may be on NFS.
+'''
+
+import math, os, socket, time
+from typing import List, Optional, Set
+
+class StationLeases():
+    def __init__(self, lockdir: str, worker_id: Optional[str]=None, \
+                 ttl: Optional[float]=120) -> None:
+        self.ttl = ttl
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.workerdir = os.path.join(lockdir, 'workers')
+        self.stationdir = os.path.join(lockdir, 'stations')
+        for d in (self.workerdir, self.stationdir):
+            os.makedirs(d, exist_ok=True)
+        self.held: Set[str] = set()
+
+    def _lease(self, station: str) -> str:
+        return os.path.join(self.stationdir, station)
+
+    def _stale(self, path: str) -> bool:
+        try:
+            return time.time() - os.stat(path).st_mtime > self.ttl
+        except FileNotFoundError:
+            return True
+
+    def _owner(self, path: str) -> Optional[str]:
+        try:
+            with open(path, 'r') as lease:
+                return lease.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def live_workers(self) -> List[str]:
+        workers = []
+        for w in os.listdir(self.workerdir):
+            if not self._stale(os.path.join(self.workerdir, w)):
+                workers.append(w)
+        return workers
+
+    def _try_claim(self, station: str) -> bool:
+        path = self._lease(station)
+        if os.path.exists(path):
+            ## A restarted worker with the same id takes its leases back.
+            if self._owner(path) == self.worker_id:
+                os.utime(path)
+                return True
+            if not self._stale(path):
+                return False
+            ## Only one worker can win the rename of a stale lease.
+            try:
+                os.rename(path, f'{path}.stale-{self.worker_id}')
+                os.remove(f'{path}.stale-{self.worker_id}')
+            except FileNotFoundError:
+                return False
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as lease:
+            lease.write(self.worker_id)
+        return True
+
+    def release(self, station: str) -> None:
+        path = self._lease(station)
+        if self._owner(path) == self.worker_id:
+            os.remove(path)
+        self.held.discard(station)
+
+    def release_all(self) -> None:
+        for station in list(self.held):
+            self.release(station)
+        try:
+            os.remove(os.path.join(self.workerdir, self.worker_id))
+        except FileNotFoundError:
+            pass
+
+    def refresh(self, stations: List[str]) -> Set[str]:
+        '''
+        Heartbeat, renew held leases, and rebalance: claim free or stale
+        stations up to a fair share of the live workers, and release any
+        beyond it. Returns the set of stations this worker now holds.
+        '''
+        with open(os.path.join(self.workerdir, self.worker_id), 'w') as hb:
+            hb.write(str(time.time()))
+
+        for station in list(self.held):
+            path = self._lease(station)
+            if self._owner(path) == self.worker_id:
+                os.utime(path)
+            else:
+                self.held.discard(station)
+
+        share = math.ceil(len(stations) / max(1, len(self.live_workers())))
+        for station in stations:
+            if len(self.held) >= share:
+                break
+            if station not in self.held and self._try_claim(station):
+                self.held.add(station)
+        for station in sorted(self.held)[share:]:
+            self.release(station)
+        return set(self.held)
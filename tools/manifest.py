@@ -0,0 +1,231 @@
+'''
+A local index of every frame in the image archive, so that batch jobs
+can find images by station and time without listing the bucket.
+
+The manifest is a SQLite file with one row per frame: its full
+resolution key, or for frames kept only as a resized copy (see
+--prefilter in scraper.py) that copy's key. ImageScraper adds rows as it writes, and `reconcile` picks up anything
+that reached the archive some other way by listing only the keys after
+each station's newest entry, less a lookback window for frames that were
+stored late (uploads replayed after an S3 outage).
+'''
+
+import os, re, sqlite3, threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+## An image's station folder and file name, and the timestamp (with its
+## UTC offset) in the name. Shared by everything that parses image paths.
+regex_path = re.compile(r'([^/]*)/([^/]*.jpg)$')
+regex_date = re.compile(r'(\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?[-+]\d\d:\d\d)')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    key TEXT PRIMARY KEY,
+    station TEXT NOT NULL,
+    time_stamp TEXT NOT NULL,
+    epoch REAL NOT NULL,
+    small_key TEXT,
+    size INTEGER,
+    etag TEXT,
+    duplicate INTEGER NOT NULL DEFAULT 0,
+    full INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS frames_station_epoch ON frames (station, epoch);
+'''
+
+## Columns added since the first version, for upgrading old manifests.
+ADDED_COLUMNS = dict(duplicate='INTEGER NOT NULL DEFAULT 0', full='INTEGER NOT NULL DEFAULT 1')
+
+def parse_key(key: str) -> Optional[Dict[str, Any]]:
+    '''
+    Split an archive key of the form "{prefix}/{base}/{base}_{ts}.jpg"
+    into its station id and timestamp. A resized copy's key
+    ("small-{base}_{ts}.jpg") is parsed as a thumbnail-only frame, with
+    `full` False; only pass those that have no full resolution copy (see
+    `thumbnail_only`). Returns None for anything else.
+    '''
+    match = regex_path.search(key)
+    if not match:
+        return None
+    base, fname = match.groups()
+    full = not fname.startswith('small-')
+    if not full:
+        fname = fname[len('small-'):]
+    stamp_match = regex_date.search(fname)
+    if 'small' in fname or not stamp_match:
+        return None
+    ts = datetime.fromisoformat(stamp_match.groups()[0])
+    small_key = key if not full else key[:-len(fname)] + 'small-' + fname
+    return dict(key=key, station=f'Axis-{base}', time_stamp=ts, small_key=small_key, full=full)
+
+def full_key(key: str) -> str:
+    '''
+    The full resolution key of a frame, given either of its keys.
+    '''
+    head, sep, fname = key.rpartition('/')
+    return head + sep + fname[len('small-'):] if fname.startswith('small-') else key
+
+def thumbnail_only(full: Iterable[str], small: Iterable[str]) -> List[str]:
+    '''
+    Keys of the frames kept only as a resized copy, out of the full
+    resolution and resized keys listed over the same range.
+    '''
+    have = set(full)
+    return [k for k in small if full_key(k) not in have]
+
+def rewind(key: str, lookback: timedelta) -> str:
+    '''
+    A key to list from instead of the watermark `key`, covering frames
+    up to `lookback` older than it.
+    '''
+    match = regex_date.search(key)
+    if not match or not lookback:
+        return key
+    ts = datetime.fromisoformat(match.groups()[0]) - lookback
+    return key[:match.start()] + ts.isoformat()
+
+class Manifest():
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        columns = [r[1] for r in self.conn.execute('PRAGMA table_info(frames)')]
+        with self.conn:
+            for name, decl in ADDED_COLUMNS.items():
+                if name not in columns:
+                    self.conn.execute(f'ALTER TABLE frames ADD COLUMN {name} {decl}')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def add(self, key: str, time_stamp: datetime, station: str, \
+            small_key: Optional[str]=None, size: Optional[int]=None, \
+            etag: Optional[str]=None, duplicate: Optional[bool]=False, \
+            full: Optional[bool]=True) -> None:
+        self.add_many([dict(key=key, station=station, time_stamp=time_stamp, small_key=small_key,
+                            size=size, etag=etag, duplicate=duplicate, full=full)])
+
+    def add_many(self, rows: List[Dict[str, Any]]) -> None:
+        '''
+        Insert or update frames, each given as a dict with the keys of
+        `parse_key` plus optional `size`, `etag` and `duplicate`. Rows
+        without `duplicate` (e.g. from a listing) keep the stored flag.
+        '''
+        params = [(r['key'], r['station'], r['time_stamp'].isoformat(),
+                   r['time_stamp'].timestamp(), r.get('small_key'),
+                   r.get('size'), r.get('etag'), int(r.get('full', True)),
+                   r.get('duplicate')) for r in rows]
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                INSERT INTO frames
+                (key, station, time_stamp, epoch, small_key, size, etag, full, duplicate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, 0))
+                ON CONFLICT (key) DO UPDATE SET
+                    station = excluded.station, time_stamp = excluded.time_stamp,
+                    epoch = excluded.epoch, small_key = excluded.small_key,
+                    size = excluded.size, etag = excluded.etag, full = excluded.full,
+                    duplicate = COALESCE(?, duplicate)''',
+                [p + (p[-1],) for p in params])
+
+    def query(self, station: Optional[str]=None, start: Optional[datetime]=None, \
+              end: Optional[datetime]=None) -> Iterator[Dict[str, Any]]:
+        '''
+        Frames for a station (or all stations) with start <= time < end,
+        in chronological order.
+        '''
+        where, params = [], []
+        if station is not None:
+            where.append('station = ?')
+            params.append(station)
+        if start is not None:
+            where.append('epoch >= ?')
+            params.append(start.timestamp())
+        if end is not None:
+            where.append('epoch < ?')
+            params.append(end.timestamp())
+        sql = 'SELECT key, station, time_stamp, small_key, size, etag, duplicate, full FROM frames'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY station, epoch'
+
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        for key, station, ts, small_key, size, etag, duplicate, full in rows:
+            yield dict(key=key, station=station, time_stamp=datetime.fromisoformat(ts),
+                       small_key=small_key, size=size, etag=etag, duplicate=bool(duplicate),
+                       full=bool(full))
+
+    def stations(self) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT station FROM frames ORDER BY station')
+            return [r[0] for r in rows.fetchall()]
+
+    def watermarks(self) -> Dict[str, str]:
+        '''
+        The lexically greatest key recorded under each station folder, as
+        a full resolution key.
+        '''
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT MAX(REPLACE(key, '/small-', '/')) FROM frames GROUP BY station''').fetchall()
+        return {os.path.dirname(key)+'/': key for (key,) in rows if key}
+
+    def reconcile(self, s3: Any, bucket: str, prefix: str, \
+                  lookback: Optional[timedelta]=timedelta(days=1)) -> int:
+        '''
+        Add frames from an S3 archive that are missing from the manifest.
+        Only keys after each station's watermark (less `lookback`) are
+        listed, so this is cheap to run regularly. Returns the number of
+        frames added.
+        '''
+        marks = self.watermarks()
+        with self.lock:
+            before = self.conn.execute('SELECT COUNT(*) FROM frames').fetchone()[0]
+        paginator = s3.get_paginator('list_objects_v2')
+        folders = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix.rstrip('/')+'/', Delimiter='/'):
+            folders += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+
+        for folder in folders:
+            if folder.endswith('/metadata/'):
+                continue
+            base = folder.rstrip('/').rsplit('/',1)[-1]
+            start = rewind(marks[folder], lookback) if folder in marks else ''
+            ## Full resolution frames, and the resized copies of the same
+            ## range to find the frames that only have those.
+            listed = dict()
+            for fname in (f'{base}_', f'small-{base}_'):
+                params = dict(Bucket=bucket, Prefix=folder + fname)
+                if start:
+                    params['StartAfter'] = folder + fname + start[len(folder + base + '_'):]
+                for page in paginator.paginate(**params):
+                    listed.update({obj['Key']: obj for obj in page.get('Contents', [])})
+            full = [k for k in listed if not k.startswith(folder + 'small-')]
+            rows = []
+            for key in full + thumbnail_only(full, listed):
+                row = parse_key(key)
+                if row:
+                    row.update(size=listed[key]['Size'], etag=listed[key]['ETag'])
+                    rows.append(row)
+            if rows:
+                self.add_many(rows)
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM frames').fetchone()[0] - before
+
+if __name__ == '__main__':
+    import boto3 # type: ignore
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Reconcile a local manifest with an S3 image archive.')
+    parser.add_argument('manifest', help='Path to the manifest SQLite file.')
+    parser.add_argument('archive', help="Archive location, e.g. s3://my-bucket/AlertWildfire")
+    parser.add_argument('--lookback', type=float, default=24,
+                        help='Also relist this many hours before each station\'s newest frame.')
+    args = parser.parse_args()
+
+    bucket, prefix = args.archive[5:].split('/',1)
+    manifest = Manifest(args.manifest)
+    n = manifest.reconcile(boto3.client('s3'), bucket, prefix, timedelta(hours=args.lookback))
+    print('Added', n, 'frames')
@@ -0,0 +1,179 @@
+'''
+Instrumentation for the scraper.
+
+`Metrics` keeps per-station, per-stage timings and byte counts, error
+counts by exception type, and sweep durations. They can be exported in
+two ways:
+
+ - as JSON lines appended to a log file, one event per captured frame,
+   error and sweep, for log collectors;
+ - in the Prometheus text format, from an HTTP endpoint started with
+   `serve(port)` (any path; /metrics by convention).
+
+Values that are only meaningful at the time of a scrape, such as how
+stale each station is, come from `gauges` callbacks that return
+(name, labels, value) tuples.
+'''
+
+import json, threading, time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+Labels = Tuple[Tuple[str, str], ...]
+Gauge = Tuple[str, Dict[str, Any], float]
+
+def _labels(**kwargs: Any) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+def _fmt(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        inner = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                         for k, v in labels)
+        name = f'{name}{{{inner}}}'
+    value = float(value)
+    return f'{name} {int(value) if value.is_integer() else value}'
+
+def percentile(values: Iterable[float], p: float) -> float:
+    '''
+    The value at quantile `p` (0 to 1) of `values`, or 0 if there are none.
+    '''
+    v = sorted(values)
+    return v[min(len(v)-1, int(p*len(v)))] if v else 0.0
+
+class Metrics():
+    def __init__(self, log_path: Optional[str]=None, samples: Optional[int]=1000) -> None:
+        self.lock = threading.Lock()
+        self.log_path = log_path
+        self.log_file = open(log_path, 'a', buffering=1) if log_path else None
+        self.counters: Dict[str, Dict[Labels, float]] = dict()
+        self.histograms: Dict[str, List[int]] = dict()
+        self.hist_sums: Dict[str, float] = dict()
+        ## Recent raw timings per stage, for percentiles.
+        self.nsamples = samples
+        self.samples: Dict[str, List[float]] = dict()
+        self.gauges: List[Callable[[], List[Gauge]]] = []
+        self.last_sweep: Dict[str, float] = dict()
+        self.httpd: Optional[ThreadingHTTPServer] = None
+
+    def inc(self, name: str, value: Optional[float]=1, **labels: Any) -> None:
+        with self.lock:
+            series = self.counters.setdefault(name, dict())
+            key = _labels(**labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, station: str, stage: str, seconds: float) -> None:
+        with self.lock:
+            hist = self.histograms.setdefault(stage, [0]*(len(BUCKETS)+1))
+            for i, b in enumerate(BUCKETS):
+                if seconds <= b:
+                    hist[i] += 1
+            hist[-1] += 1
+            self.hist_sums[stage] = self.hist_sums.get(stage, 0.0) + seconds
+            self.samples[stage] = self.samples.get(stage, [])[-(self.nsamples-1):] + [seconds]
+        self.inc('alertwf_stage_seconds_total', seconds, station=station, stage=stage)
+        self.inc('alertwf_stage_calls_total', 1, station=station, stage=stage)
+
+    @contextmanager
+    def timer(self, station: str, stage: str, timings: Optional[Dict[str, float]]=None) -> Iterator[None]:
+        '''
+        Time a block as one stage of a station's capture. The duration is
+        also stored in `timings[stage]` if given.
+        '''
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.observe(station, stage, dt)
+            if timings is not None:
+                timings[stage] = dt
+
+    def add_bytes(self, station: str, stage: str, n: int) -> None:
+        self.inc('alertwf_bytes_total', n, station=station, stage=stage)
+
+    def error(self, station: str, stage: str, exc: BaseException) -> None:
+        kind = type(exc).__name__
+        self.inc('alertwf_errors_total', 1, station=station, stage=stage, type=kind)
+        self.log(event='error', station=station, stage=stage, type=kind, error=str(exc))
+
+    def sweep(self, duration: float, delay: float, polled: int, errors: int) -> None:
+        overrun = duration > delay
+        with self.lock:
+            self.last_sweep = dict(duration=duration, delay=delay, time=time.time())
+        self.inc('alertwf_sweeps_total')
+        self.inc('alertwf_sweep_seconds_total', duration)
+        if overrun:
+            self.inc('alertwf_sweep_overruns_total')
+        self.log(event='sweep', duration=round(duration, 4), delay=delay, overrun=overrun,
+                 polled=polled, errors=errors)
+
+    def percentile(self, stage: str, p: float) -> float:
+        with self.lock:
+            v = list(self.samples.get(stage, []))
+        return percentile(v, p)
+
+    def log(self, **event: Any) -> None:
+        if self.log_file is None:
+            return
+        line = json.dumps(dict(time=time.time(), **event), default=str)
+        with self.lock:
+            self.log_file.write(line + '\n')
+
+    def render(self) -> str:
+        '''
+        All metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                lines += [_fmt(name, labels, v) for labels, v in sorted(series.items())]
+            if self.histograms:
+                lines.append('# TYPE alertwf_stage_seconds histogram')
+            for stage, hist in sorted(self.histograms.items()):
+                for b, n in zip(BUCKETS + ['+Inf'], hist):
+                    lines.append(_fmt('alertwf_stage_seconds_bucket', _labels(stage=stage, le=b), n))
+                lines.append(_fmt('alertwf_stage_seconds_sum', _labels(stage=stage), self.hist_sums[stage]))
+                lines.append(_fmt('alertwf_stage_seconds_count', _labels(stage=stage), hist[-1]))
+            sweep = dict(self.last_sweep)
+        gauges: List[Gauge] = []
+        if sweep:
+            gauges += [('alertwf_sweep_seconds', dict(), sweep['duration']),
+                       ('alertwf_sweep_delay_seconds', dict(), sweep['delay']),
+                       ('alertwf_last_sweep_timestamp_seconds', dict(), sweep['time'])]
+        for collect in self.gauges:
+            gauges += collect()
+        seen = set()
+        for name, labels, value in gauges:
+            if name not in seen:
+                lines.append(f'# TYPE {name} gauge')
+                seen.add(name)
+            lines.append(_fmt(name, _labels(**labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: Optional[str]='') -> None:
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('content-type', 'text/plain; version=0.0.4')
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        if self.log_file is not None:
+            self.log_file.close()
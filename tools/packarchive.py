@@ -0,0 +1,200 @@
+'''
+Packed archive format: a few container files per station per day instead
+of two small objects per frame.
+
+A pack is the full resolution and resized JPEGs of each frame appended
+back to back. Alongside it, an index (JSON lines, one per frame) gives
+the timestamp and the byte range of both images, so a single frame can
+be fetched from S3 with one ranged GET, and whether the frame is a
+near-duplicate of the one before (see --dedup flag in scraper.py).
+Frames kept as thumbnails only have an empty full resolution range. A day's frames may be split
+over several segments, each named after the time of its first frame:
+
+    {base}/{base}_{YYYY-MM-DD}.{HHMMSS}.pack
+    {base}/{base}_{YYYY-MM-DD}.{HHMMSS}.pack.idx
+
+Packs are written locally. For S3 destinations they are staged in a
+local directory and uploaded in full once the day is complete. Packs
+for the current day are also uploaded as they stand on shutdown, and
+staged packs left from a previous run are recovered at startup. A
+segment is never written to again once it's final: frames for its day
+that arrive later start a new segment, so an uploaded pack is never
+replaced by a shorter one.
+'''
+
+import json, os, re, threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+## Packs from before segments were introduced have no segment part.
+regex_pack = re.compile(r'([^/]*)_(\d\d\d\d-\d\d-\d\d)(?:\.(\d{6}))?\.pack$')
+
+def pack_name(base: str, day: str, segment: Optional[str]=None) -> str:
+    if segment is None:
+        return f'{base}_{day}.pack'
+    return f'{base}_{day}.{segment}.pack'
+
+class PackWriter():
+    '''
+    Appends frames to per-station daily packs under `root`. If `upload`
+    is given, it's called as upload(base, fname, path, final) for each
+    pack and index to be sent to the destination. When `final` is set the
+    segment is complete, and the uploader should remove the local file
+    once it's stored.
+    '''
+    def __init__(self, root: str, upload: Optional[Callable[[str, str, str, bool], None]]=None) -> None:
+        self.root = root
+        self.upload = upload
+        self.lock = threading.Lock()
+        ## Station -> (day, pack file name) of the segment being appended to.
+        self.current: Dict[str, Tuple[str, str]] = dict()
+
+    def _paths(self, base: str, fname: str) -> Tuple[str, str]:
+        path = os.path.join(self.root, base, fname)
+        return path, path + '.idx'
+
+    def append(self, base: str, ts: datetime, full: bytes, small: bytes, \
+               duplicate: Optional[bool]=False) -> Tuple[str, int]:
+        '''
+        Add one frame to its station's pack for the day. `full` is empty
+        for frames kept as thumbnails only. Returns the pack's file name
+        and the frame's offset in it.
+        '''
+        day = ts.date().isoformat()
+        with self.lock:
+            if base in self.current and self.current[base][0] != day:
+                self.finish(base, self.current[base][1])
+            if base not in self.current:
+                self.current[base] = (day, pack_name(base, day, ts.strftime('%H%M%S')))
+            fname = self.current[base][1]
+
+            path, idx = self._paths(base, fname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as pack:
+                offset = pack.tell()
+                pack.write(full)
+                pack.write(small)
+            entry = dict(time=ts.isoformat(), full=[offset, len(full)],
+                         small=[offset+len(full), len(small)], duplicate=duplicate)
+            with open(idx, 'a') as index:
+                index.write(json.dumps(entry) + '\n')
+        return fname, offset
+
+    def finish(self, base: str, fname: str, final: Optional[bool]=True) -> None:
+        path, idx = self._paths(base, fname)
+        if final and self.current.get(base, (None, None))[1] == fname:
+            self.current.pop(base)
+        if self.upload is not None and os.path.exists(path):
+            self.upload(base, fname, path, final)
+            self.upload(base, fname + '.idx', idx, final)
+
+    def sync(self, before: Optional[str]=None) -> None:
+        '''
+        Upload every staged pack. Packs for days before `before`
+        (YYYY-MM-DD) are final; the rest are uploaded as they are so far
+        and kept staged for more frames. Used at startup, to recover packs
+        left by a previous run, and at shutdown.
+
+        Days are each station's local dates, so `before` should leave a
+        day's margin over the host's date for stations in other time
+        zones. Finalizing a day too early is safe, though: later frames
+        for it go to a new segment.
+        '''
+        if not os.path.isdir(self.root):
+            return
+        with self.lock:
+            for base in os.listdir(self.root):
+                for fname in sorted(os.listdir(os.path.join(self.root, base))):
+                    match = regex_pack.search(fname)
+                    if not match:
+                        continue
+                    day = match.groups()[1]
+                    final = before is not None and day < before
+                    ## Carry on appending to the latest segment left staged.
+                    if not final and self.current.get(base, (day,))[0] <= day:
+                        self.current[base] = (day, fname)
+                    self.finish(base, fname, final)
+
+def parse_index(data: bytes) -> List[Dict[str, Any]]:
+    entries = [json.loads(line) for line in data.decode().splitlines() if line.strip()]
+    for e in entries:
+        e['time'] = datetime.fromisoformat(e['time'])
+    return entries
+
+class PackReader():
+    '''
+    Read frames from packs in a local directory or an S3 prefix.
+    '''
+    def __init__(self, root: str, s3: Any=None) -> None:
+        self.s3 = s3
+        if root.startswith('s3://'):
+            self.bucket, self.prefix = root[5:].split('/', 1)
+            self.prefix = self.prefix.rstrip('/')
+        else:
+            self.bucket, self.prefix = None, root
+        self.indexes: Dict[str, List[Dict[str, Any]]] = dict()
+
+    def _key(self, base: str, fname: str) -> str:
+        if self.bucket is None:
+            return os.path.join(self.prefix, base, fname)
+        return f'{self.prefix}/{base}/{fname}'
+
+    def _read(self, key: str, rng: Optional[List[int]]=None) -> bytes:
+        if self.bucket is None:
+            with open(key, 'rb') as src:
+                if rng is None:
+                    return src.read()
+                src.seek(rng[0])
+                return src.read(rng[1])
+        params = dict(Bucket=self.bucket, Key=key)
+        if rng is not None:
+            params['Range'] = f'bytes={rng[0]}-{rng[0]+rng[1]-1}'
+        return self.s3.get_object(**params)['Body'].read()
+
+    def segments(self, base: str, day: str) -> List[str]:
+        '''
+        File names of a station's packs for one day, in order.
+        '''
+        if self.bucket is None:
+            folder = os.path.join(self.prefix, base)
+            names = os.listdir(folder) if os.path.isdir(folder) else []
+        else:
+            paginator = self.s3.get_paginator('list_objects_v2')
+            names = [obj['Key'].rsplit('/', 1)[-1]
+                     for page in paginator.paginate(Bucket=self.bucket,
+                                                    Prefix=self._key(base, f'{base}_{day}.'))
+                     for obj in page.get('Contents', [])]
+        matches = (regex_pack.fullmatch(n) for n in names)
+        return sorted(m.group(0) for m in matches if m and m.groups()[:2] == (base, day))
+
+    def index(self, base: str, day: str) -> List[Dict[str, Any]]:
+        '''
+        Index entries of every frame of a day, each with the name of the
+        pack it's in.
+        '''
+        key = f'{base}_{day}'
+        if key not in self.indexes:
+            entries = []
+            for fname in self.segments(base, day):
+                for e in parse_index(self._read(self._key(base, fname + '.idx'))):
+                    e['pack'] = fname
+                    entries.append(e)
+            self.indexes[key] = sorted(entries, key=lambda e: e['time'])
+        return self.indexes[key]
+
+    def frames(self, base: str, day: str) -> Iterator[Dict[str, Any]]:
+        yield from self.index(base, day)
+
+    def read(self, base: str, ts: datetime, small: Optional[bool]=False) -> bytes:
+        '''
+        Fetch one frame by its timestamp, with a single ranged read.
+        Raises KeyError for the full resolution image of a frame kept as
+        a thumbnail only.
+        '''
+        for entry in self.index(base, ts.date().isoformat()):
+            if entry['time'] == ts:
+                rng = entry['small' if small else 'full']
+                if rng[1] == 0:
+                    raise KeyError(f'Frame at {ts.isoformat()} for {base} was kept as a thumbnail only')
+                return self._read(self._key(base, entry['pack']), rng)
+        raise KeyError(f'No frame at {ts.isoformat()} for {base}')
@@ -0,0 +1,82 @@
+'''
+Cheap on-device scoring of frames, to decide which are worth uploading
+at full resolution.
+
+A scorer is called as scorer(station, thumbnail) with the JPEG bytes of
+a frame's resized copy, and returns a score; frames scoring at or above
+the scraper's threshold are uploaded in full, the rest as thumbnails
+only. Scorers are chosen by name with `get_scorer`: either one of
+SCORERS, or "module:attribute" naming a class or zero-argument
+factory, in any importable module, that returns a scorer.
+
+The built-in "anomaly" scorer needs no model. It computes the same
+per-image features as the `images` table (tools/features.py) on a
+further downscaled grayscale copy, and scores a frame by how far it
+departs from that station's recent frames, as the largest z-score of
+any feature against a running mean and variance.
+'''
+
+import importlib, io, threading
+import numpy as np # type: ignore
+from PIL import Image # type: ignore
+from tools.features import FEATURES, batch_features
+from typing import Callable, Dict, Optional, Tuple
+
+Scorer = Callable[[str, bytes], float]
+
+def decode_gray_small(data: bytes, scale: Optional[int]=4) -> np.ndarray:
+    '''
+    Grayscale decode at 1/`scale` size, most of which libjpeg does by
+    skipping DCT coefficients.
+    '''
+    img = Image.open(io.BytesIO(data))
+    img.draft('L', (img.size[0]//scale, img.size[1]//scale))
+    return np.asarray(img.convert('L'))
+
+class AnomalyScorer():
+    '''
+    Score frames by their deviation from an exponentially weighted
+    running mean and variance of each station's features. The first
+    `warmup` frames of a station score infinity, so they're kept in full.
+    '''
+    def __init__(self, alpha: Optional[float]=0.05, warmup: Optional[int]=10, \
+                 scale: Optional[int]=4) -> None:
+        self.alpha = alpha
+        self.warmup = warmup
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.state: Dict[str, Tuple[int, np.ndarray, np.ndarray]] = dict()
+
+    def features(self, thumbnail: bytes) -> np.ndarray:
+        gray = decode_gray_small(thumbnail, self.scale)
+        feats = batch_features(gray[None])
+        return np.array([feats[k][0] for k in FEATURES])
+
+    def __call__(self, station: str, thumbnail: bytes) -> float:
+        x = self.features(thumbnail)
+        with self.lock:
+            n, mean, var = self.state.get(station, (0, x, np.zeros_like(x)))
+            if n < self.warmup:
+                score = float('inf')
+            else:
+                z = np.abs(x - mean) / np.sqrt(var + 1e-6)
+                score = float(z.max())
+            d = x - mean
+            mean = mean + self.alpha * d
+            var = (1 - self.alpha) * (var + self.alpha * d * d)
+            self.state[station] = (n + 1, mean, var)
+        return score
+
+    def forget(self, station: str) -> None:
+        with self.lock:
+            self.state.pop(station, None)
+
+SCORERS: Dict[str, Callable[[], Scorer]] = dict(anomaly=AnomalyScorer)
+
+def get_scorer(name: str) -> Scorer:
+    if name in SCORERS:
+        return SCORERS[name]()
+    module, _, attr = name.partition(':')
+    if not attr:
+        raise ValueError(f'Unknown scorer {name}, expected one of {list(SCORERS)} or module:attribute')
+    return getattr(importlib.import_module(module), attr)()
@@ -0,0 +1,168 @@
+'''
+Local stand-in for the AlertWildfire bucket, for benchmarking the
+scraper offline.
+
+A recording is a directory of camera metadata snapshots and frames:
+
+    {recording}/all_cameras-v2/*.json
+    {recording}/frames/{station_id}/*.jpg
+
+`ReplayServer` serves them at the same paths as the real bucket
+({url}/all_cameras-v2.json and {url}/{station_id}/latest_full.jpg),
+with a fixed added latency. Any number of stations can be served: the
+recorded ones are reused in turn under names "Replay-0000", etc. Each
+station's latest frame advances every `frame_interval` seconds, with its
+EXIF capture time rewritten so every frame is seen as new, and the
+usual ETag/If-None-Match handling.
+
+`record` fills a recording directory from the live bucket.
+'''
+
+import hashlib, io, json, os, threading, time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tools.imgtools import read_exif
+from typing import Dict, List, Optional, Tuple
+
+class Recording():
+    def __init__(self, path: str) -> None:
+        mddir = os.path.join(path, 'all_cameras-v2')
+        self.metadata = []
+        for fname in sorted(os.listdir(mddir)):
+            with open(os.path.join(mddir, fname), 'r') as src:
+                self.metadata.append(json.load(src))
+
+        ## Each frame is kept with its original capture time string, and
+        ## its time zone offset (hours), so the time can be rewritten.
+        self.frames: Dict[str, List[Tuple[bytes, bytes, int]]] = dict()
+        framedir = os.path.join(path, 'frames')
+        for station in sorted(os.listdir(framedir)):
+            frames = []
+            for fname in sorted(os.listdir(os.path.join(framedir, station))):
+                with open(os.path.join(framedir, station, fname), 'rb') as src:
+                    data = src.read()
+                exif = read_exif(io.BytesIO(data))
+                stamp = exif.get('DateTimeOriginal', '').encode()
+                frames.append((data, stamp, int(exif.get('TimeZoneOffset', 0))))
+            if frames:
+                self.frames[station] = frames
+        assert self.metadata and self.frames, f'Empty recording: {path}'
+
+def record(path: str, stations: List[str], frames: int, interval: float) -> None:
+    '''
+    Save `frames` snapshots of the metadata and of each station's latest
+    image, `interval` seconds apart.
+    '''
+    from tools.alertwf import get_metadata, fetch_latest_image, forget_image
+    os.makedirs(os.path.join(path, 'all_cameras-v2'), exist_ok=True)
+    for i in range(frames):
+        with open(os.path.join(path, 'all_cameras-v2', f'{i:04d}.json'), 'w') as dest:
+            json.dump(get_metadata(ttl=0), dest)
+        for station in stations:
+            forget_image(station)
+            data = fetch_latest_image(station)
+            os.makedirs(os.path.join(path, 'frames', station), exist_ok=True)
+            with open(os.path.join(path, 'frames', station, f'{i:04d}.jpg'), 'wb') as dest:
+                dest.write(data)
+        print('Recorded', i+1, 'of', frames, end='\r')
+        if i < frames - 1:
+            time.sleep(interval)
+    print()
+
+class ReplayServer():
+    def __init__(self, recording: Recording, stations: Optional[int]=None, \
+                 latency: Optional[float]=0.0, frame_interval: Optional[float]=10.0, \
+                 port: Optional[int]=0) -> None:
+        self.recording = recording
+        self.latency = latency
+        self.frame_interval = frame_interval
+        self.start = time.time()
+
+        recorded = list(recording.frames)
+        if stations is None:
+            self.sources = {s: s for s in recorded}
+        else:
+            self.sources = {f'Replay-{i:04d}': recorded[i % len(recorded)] for i in range(stations)}
+        self.requests = dict(image=0, not_modified=0, metadata=0)
+        self.lock = threading.Lock()
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                server.handle(self)
+            def log_message(self, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d' % self.httpd.server_address[:2]
+
+    @property
+    def stations(self) -> List[str]:
+        return list(self.sources)
+
+    def __enter__(self) -> 'ReplayServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def metadata(self) -> bytes:
+        snapshots = self.recording.metadata
+        data = snapshots[int((time.time() - self.start) / self.frame_interval) % len(snapshots)]
+        by_id = {f['properties']['id']: f for f in data['features']}
+        features = []
+        for name, source in self.sources.items():
+            feature = json.loads(json.dumps(by_id.get(source) or data['features'][0]))
+            feature['properties']['id'] = name
+            features.append(feature)
+        return json.dumps(dict(data, features=features)).encode()
+
+    def frame(self, station: str) -> Tuple[bytes, str]:
+        '''
+        The station's current frame and its ETag.
+        '''
+        n = int((time.time() - self.start) / self.frame_interval)
+        frames = self.recording.frames[self.sources[station]]
+        data, stamp, tz = frames[n % len(frames)]
+        if stamp:
+            ts = datetime.fromtimestamp(self.start + n*self.frame_interval, timezone(timedelta(hours=tz)))
+            data = data.replace(stamp, ts.strftime('%Y:%m:%d %H:%M:%S').encode())
+        etag = '"%s"' % hashlib.md5(f'{station}/{n}'.encode()).hexdigest()
+        return data, etag
+
+    def handle(self, req: BaseHTTPRequestHandler) -> None:
+        time.sleep(self.latency)
+        path = req.path.split('?')[0].strip('/')
+        if path == 'all_cameras-v2.json':
+            with self.lock:
+                self.requests['metadata'] += 1
+            body, ctype, etag = self.metadata(), 'application/json', None
+        elif path.endswith('/latest_full.jpg') and path.split('/')[0] in self.sources:
+            body, etag = self.frame(path.split('/')[0])
+            ctype = 'image/jpeg'
+            if req.headers.get('if-none-match') == etag:
+                with self.lock:
+                    self.requests['not_modified'] += 1
+                req.send_response(304)
+                req.send_header('etag', etag)
+                req.end_headers()
+                return
+            with self.lock:
+                self.requests['image'] += 1
+        else:
+            req.send_error(404)
+            return
+        req.send_response(200)
+        req.send_header('content-type', ctype)
+        req.send_header('content-length', str(len(body)))
+        if etag:
+            req.send_header('etag', etag)
+        req.end_headers()
+        req.wfile.write(body)
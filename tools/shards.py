@@ -0,0 +1,141 @@
+'''
+Fixed-shape uint8 image shards for training.
+
+A dataset is a directory of shards, each a .npy array of shape
+(N, H, W, C) that can be memory-mapped, with a sidecar index (JSON
+lines, one per image, in row order) giving each image's database id,
+station, timestamp, path and labels:
+
+    {dir}/dataset.json
+    {dir}/shard-00000.npy
+    {dir}/shard-00000.idx
+    ...
+
+Images are decoded and resized once, when the dataset is written, so
+reading a training batch is just a slice of a memory-mapped array.
+'''
+
+import io, json, os
+import numpy as np # type: ignore
+from PIL import Image # type: ignore
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+def shard_name(n: int) -> str:
+    return f'shard-{n:05d}.npy'
+
+def decode_resized(data: bytes, size: Tuple[int, int], gray: Optional[bool]=False) -> np.ndarray:
+    '''
+    Decode a JPEG straight to (width, height) `size`. Draft mode lets
+    libjpeg do most of the downscaling while decoding.
+    '''
+    mode = 'L' if gray else 'RGB'
+    img = Image.open(io.BytesIO(data))
+    img.draft(mode, size)
+    img = img.convert(mode).resize(size, Image.BILINEAR)
+    arr = np.asarray(img, dtype=np.uint8)
+    return arr[:,:,None] if gray else arr
+
+class ShardWriter():
+    '''
+    Write images of one fixed shape (H, W, C) into shards of up to
+    `shard_size` images each.
+    '''
+    def __init__(self, outdir: str, shape: Tuple[int, int, int], shard_size: Optional[int]=4096) -> None:
+        self.outdir = outdir
+        self.shape = tuple(shape)
+        self.shard_size = shard_size
+        self.shards: List[Dict[str, Any]] = []
+        self.array: Optional[np.ndarray] = None
+        self.index: Any = None
+        self.row = 0
+        os.makedirs(outdir, exist_ok=True)
+
+    def _open(self) -> None:
+        fname = shard_name(len(self.shards))
+        path = os.path.join(self.outdir, fname)
+        self.array = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                               shape=(self.shard_size,)+self.shape)
+        self.index = open(path[:-4] + '.idx', 'w')
+        self.shards.append(dict(file=fname, count=0))
+        self.row = 0
+
+    def _close(self) -> None:
+        if self.array is None:
+            return
+        path = os.path.join(self.outdir, self.shards[-1]['file'])
+        self.array.flush()
+        if self.row < self.shard_size:
+            ## Rewrite the last, partial shard at its actual length so that
+            ## its shape matches the index.
+            trimmed = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint8,
+                                                shape=(self.row,)+self.shape)
+            trimmed[:] = self.array[:self.row]
+            trimmed.flush()
+            del trimmed
+            os.replace(path + '.tmp', path)
+        self.index.close()
+        self.shards[-1]['count'] = self.row
+        self.array = None
+
+    def append(self, image: np.ndarray, meta: Dict[str, Any]) -> None:
+        if image.shape != self.shape:
+            raise ValueError(f'Image shape {image.shape} does not match dataset shape {self.shape}')
+        if self.array is None or self.row == self.shard_size:
+            self._close()
+            self._open()
+        self.array[self.row] = image
+        self.index.write(json.dumps(meta, default=str) + '\n')
+        self.row += 1
+
+    def close(self, **info: Any) -> None:
+        '''
+        Finish the last shard and write dataset.json, including any
+        extra `info` (e.g. the query the dataset was built from).
+        '''
+        self._close()
+        meta = dict(shape=list(self.shape), dtype='uint8', shards=self.shards,
+                    count=sum(s['count'] for s in self.shards), **info)
+        with open(os.path.join(self.outdir, 'dataset.json'), 'w') as dest:
+            json.dump(meta, dest, indent=2, default=str)
+
+class ShardedDataset():
+    '''
+    Read a dataset written by ShardWriter. Shards are memory-mapped, so
+    indexing returns a view of the file without copying or decoding.
+    '''
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, 'dataset.json'), 'r') as src:
+            self.info = json.load(src)
+        self.arrays = [np.load(os.path.join(path, s['file']), mmap_mode='r')
+                       for s in self.info['shards']]
+        self.offsets = np.cumsum([0] + [len(a) for a in self.arrays])
+        self.path = path
+        self._index: Optional[List[Dict[str, Any]]] = None
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if i < 0:
+            i += len(self)
+        s = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.arrays[s][i - self.offsets[s]]
+
+    @property
+    def index(self) -> List[Dict[str, Any]]:
+        if self._index is None:
+            self._index = []
+            for s in self.info['shards']:
+                with open(os.path.join(self.path, s['file'][:-4] + '.idx'), 'r') as src:
+                    self._index += [json.loads(line) for line in src if line.strip()]
+        return self._index
+
+    def shards(self) -> Iterator[Tuple[np.ndarray, List[Dict[str, Any]]]]:
+        '''
+        Each shard's array with its index entries, for reading in
+        contiguous blocks.
+        '''
+        n = 0
+        for arr in self.arrays:
+            yield arr, self.index[n:n+len(arr)]
+            n += len(arr)
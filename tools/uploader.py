@@ -0,0 +1,236 @@
+'''
+Background S3 uploads for the scraper.
+
+Uploads are queued and sent by a pool of threads, so a slow PUT no
+longer holds up fetching from the cameras. Failed uploads are retried
+with exponential backoff, and if S3 stays unreachable (or the queue is
+full) the data is written to a local spill directory instead. Spilled
+files are re-queued by `replay_spill`, which runs at startup and can be
+called again at any time. Whole files (such as packs) have a queue of
+their own, without a limit, so queueing one never blocks.
+
+An upload's `on_done` callback can't outlive the process, so a spilled
+upload keeps its `meta` dict in a sidecar file instead, and
+`on_replayed(key, etag, meta)` is called once it's finally stored.
+'''
+
+import io, json, os, queue, threading, time
+from tools.metrics import percentile
+from urllib.parse import quote, unquote
+from typing import Any, Callable, Dict, List, Optional, Union
+
+OnDone = Optional[Callable[[str, str], None]]
+OnReplayed = Optional[Callable[[str, str, Dict[str, Any]], None]]
+
+class Uploader():
+    def __init__(self, s3: Any, bucket: str, spill_dir: str, workers: Optional[int]=4, \
+                 maxsize: Optional[int]=256, retries: Optional[int]=5, \
+                 backoff: Optional[float]=0.5, on_replayed: OnReplayed=None) -> None:
+        from boto3.s3.transfer import TransferConfig # type: ignore
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.spill_dir = spill_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.on_replayed = on_replayed
+        self.config = TransferConfig(multipart_threshold=8*1024**2,
+                                     multipart_chunksize=8*1024**2,
+                                     max_concurrency=4)
+        os.makedirs(spill_dir, exist_ok=True)
+
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.files: queue.Queue = queue.Queue()
+        self.closing = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.counts = dict(uploaded=0, retried=0, spilled=0, replayed=0)
+        self.replaying: set = set()
+        ## Thread -> the upload it's working on, to spill if it's still
+        ## stuck at close.
+        self.active: Dict[threading.Thread, tuple] = dict()
+
+        self.threads = [threading.Thread(target=self._worker, args=(self.queue,), daemon=True)
+                        for _ in range(workers)]
+        self.threads.append(threading.Thread(target=self._worker, args=(self.files,), daemon=True))
+        for t in self.threads:
+            t.start()
+        self.replay_spill()
+
+    def put(self, key: str, data: bytes, on_done: OnDone=None, \
+            meta: Optional[Dict[str, Any]]=None) -> None:
+        '''
+        Queue an upload. `on_done(key, etag)` is called from an upload
+        thread once it succeeds. If the queue is full, the data (and
+        `meta`) are spilled to disk instead, without waiting.
+        '''
+        try:
+            self.queue.put_nowait((key, data, on_done, meta, None))
+        except queue.Full:
+            self._spill(key, data, meta)
+
+    def put_file(self, key: str, path: str, on_done: OnDone=None) -> None:
+        '''
+        Queue the upload of a local file, which may be large. Files are
+        never spilled; if the upload fails the file is left in place.
+        '''
+        self.files.put((key, path, on_done, None, None))
+
+    def close(self, timeout: Optional[float]=None) -> None:
+        '''
+        Wait up to `timeout` seconds for queued uploads to finish, then
+        stop the upload threads. Whatever is still queued or failing by
+        then is spilled straight away, without further retries.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while (self.queue.unfinished_tasks or self.files.unfinished_tasks) \
+              and (deadline is None or time.time() < deadline):
+            time.sleep(0.1)
+        self.closing.set()
+        for q in (self.queue, self.files):
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                self._abandon(*item[:2], item[3], item[4])
+                q.task_done()
+        for _ in self.threads[:-1]:
+            self.queue.put(None)
+        self.files.put(None)
+        for t in self.threads:
+            t.join(timeout=1)
+        with self.lock:
+            stuck = list(self.active.values())
+            self.active.clear()
+        for key, data, on_done, meta, spill_path in stuck:
+            self._abandon(key, data, meta, spill_path)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(queue_depth=self.queue.qsize() + self.files.qsize(),
+                        latency_p50=percentile(self.latencies, 0.5),
+                        latency_p95=percentile(self.latencies, 0.95), **self.counts)
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, quote(key, safe='') + '.spill')
+
+    def _spill(self, key: str, data: bytes, meta: Optional[Dict[str, Any]]=None) -> None:
+        path = self._spill_path(key)
+        ## The sidecar goes first, so it's there whenever the spill file is.
+        if meta is not None:
+            with open(path[:-6] + '.meta', 'w') as dest:
+                json.dump(meta, dest)
+        with open(path + '.tmp', 'wb') as dest:
+            dest.write(data)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            self.counts['spilled'] += 1
+
+    def _abandon(self, key: str, data: Union[bytes, str], meta: Optional[Dict[str, Any]], \
+                 spill_path: Optional[str]) -> None:
+        '''
+        Give up on an upload: spill its data, unless it's a local file
+        or already spilled.
+        '''
+        if isinstance(data, str):
+            return
+        if spill_path is None:
+            self._spill(key, data, meta)
+        else:
+            with self.lock:
+                self.replaying.discard(spill_path)
+
+    def replay_spill(self) -> int:
+        '''
+        Queue any spilled uploads that aren't already queued. Returns the
+        number queued.
+        '''
+        n = 0
+        for fname in os.listdir(self.spill_dir):
+            if not fname.endswith('.spill'):
+                continue
+            path = os.path.join(self.spill_dir, fname)
+            with self.lock:
+                if path in self.replaying:
+                    continue
+                self.replaying.add(path)
+            with open(path, 'rb') as src:
+                data = src.read()
+            meta = None
+            if os.path.exists(path[:-6] + '.meta'):
+                with open(path[:-6] + '.meta', 'r') as src:
+                    meta = json.load(src)
+            on_done = None
+            if meta is not None and self.on_replayed is not None:
+                on_done = lambda key, etag, meta=meta: self.on_replayed(key, etag, meta)
+            try:
+                self.queue.put_nowait((unquote(fname[:-6]), data, on_done, meta, path))
+                n += 1
+            except queue.Full:
+                with self.lock:
+                    self.replaying.discard(path)
+                break
+        return n
+
+    def _upload(self, key: str, data: Union[bytes, str]) -> str:
+        if isinstance(data, str):
+            self.s3.upload_file(data, self.bucket, key, Config=self.config)
+            return ''
+        if len(data) < self.config.multipart_threshold:
+            res = self.s3.put_object(Bucket=self.bucket, Key=key, Body=data)
+            return res.get('ETag', '')
+        self.s3.upload_fileobj(io.BytesIO(data), self.bucket, key, Config=self.config)
+        return ''
+
+    def _worker(self, q: queue.Queue) -> None:
+        me = threading.current_thread()
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            key, data, on_done, meta, spill_path = item
+            with self.lock:
+                self.active[me] = item
+            t0 = time.time()
+            etag = None
+            for attempt in range(self.retries):
+                try:
+                    etag = self._upload(key, data)
+                    break
+                except Exception:
+                    with self.lock:
+                        self.counts['retried'] += 1
+                    ## Stop retrying as soon as we're closing.
+                    if attempt == self.retries - 1 or self.closing.wait(self.backoff * 2**attempt):
+                        break
+            with self.lock:
+                ## Already spilled by `close` if it's gone.
+                abandoned = self.active.pop(me, None) is None
+
+            if abandoned:
+                pass
+            elif etag is None:
+                self._abandon(key, data, meta, spill_path)
+            else:
+                with self.lock:
+                    self.counts['uploaded'] += 1
+                    self.latencies = self.latencies[-999:] + [time.time() - t0]
+                    if spill_path is not None:
+                        self.counts['replayed'] += 1
+                        self.replaying.discard(spill_path)
+                if spill_path is not None:
+                    ## Another process sharing the spill directory may
+                    ## have replayed the same file.
+                    for path in (spill_path, spill_path[:-6] + '.meta'):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                if on_done is not None:
+                    try:
+                        on_done(key, etag)
+                    except Exception:
+                        pass
+            q.task_done()
@@ -0,0 +1,285 @@
+'''
+Spatial index of what each camera can see, for finding the cameras (and
+then the archived frames) that cover a given location.
+
+Each camera's view is modelled as a wedge: from its position, between
+the bearings `fov_lft` and `fov_rt` (clockwise, degrees from north),
+out to the distance of its horizon given its elevation, capped at
+`max_range_km`. Terrain isn't taken into account, so the index answers
+"could see", not "can see". Cameras with no field of view reported are
+treated as seeing all around.
+
+Wedges are registered in a uniform grid of `cell` degree cells. A query
+only checks the cameras registered in the cells it touches, so point
+and bounding box lookups take well under a millisecond however many
+cameras there are. `update` takes the camera table from
+`get_all_cameras` (or `load_camera_state`) and re-registers only the
+cameras whose position or field of view changed.
+'''
+
+import math
+from datetime import datetime, timedelta, timezone
+from tools.manifest import regex_date
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+KM_PER_DEG_LAT = 110.57
+KM_PER_DEG_LON = 111.32
+
+View = Tuple[float, float, float, Optional[float], Optional[float]]
+
+def _num(v: Any) -> Optional[float]:
+    try:
+        v = float(v)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(v) else v
+
+def horizon_km(elevation_km: float) -> float:
+    '''
+    Distance to the horizon from a height above the surrounding terrain,
+    taken here as the elevation (Earth radius 6371km).
+    '''
+    return math.sqrt(max(0.0, 2*6371*elevation_km + elevation_km**2))
+
+def offset_km(lon0: float, lat0: float, lon: float, lat: float) -> Tuple[float, float]:
+    '''
+    East and north offsets of a point from (lon0, lat0), in a local flat
+    projection. Accurate to well under 1% over the ranges involved.
+    '''
+    return ((lon - lon0) * KM_PER_DEG_LON * math.cos(math.radians(lat0)),
+            (lat - lat0) * KM_PER_DEG_LAT)
+
+def bearing_in(bearing: float, left: Optional[float], right: Optional[float], \
+               margin: Optional[float]=0.0) -> bool:
+    if left is None or right is None:
+        return True
+    width = (right - left) % 360
+    return (bearing - left + margin) % 360 <= width + 2*margin
+
+class ViewshedIndex():
+    def __init__(self, cell: Optional[float]=0.1, max_range_km: Optional[float]=50.0) -> None:
+        self.cell = cell
+        self.max_range_km = max_range_km
+        ## Camera id -> (lon, lat, range_km, fov_lft, fov_rt)
+        self.views: Dict[str, View] = dict()
+        self.cells: Dict[Tuple[int, int], Set[str]] = dict()
+        self.registered: Dict[str, List[Tuple[int, int]]] = dict()
+
+    def _cell(self, lon: float, lat: float) -> Tuple[int, int]:
+        return (math.floor(lon / self.cell), math.floor(lat / self.cell))
+
+    def _view(self, row: Any) -> Optional[View]:
+        lon, lat = _num(row['longitude']), _num(row['latitude'])
+        if lon is None or lat is None:
+            return None
+        elev = _num(row.get('elevation_km')) or 0.0
+        rng = min(self.max_range_km, horizon_km(elev)) if elev > 0 else self.max_range_km
+        return (lon, lat, rng, _num(row.get('fov_lft')), _num(row.get('fov_rt')))
+
+    def _cells_for(self, view: View) -> List[Tuple[int, int]]:
+        '''
+        Grid cells a wedge may overlap: those within range of the camera
+        whose bearing range overlaps the wedge's.
+        '''
+        lon0, lat0, rng, left, right = view
+        dlat = rng / KM_PER_DEG_LAT
+        dlon = rng / (KM_PER_DEG_LON * max(0.01, math.cos(math.radians(lat0))))
+        (x0, y0), (x1, y1) = self._cell(lon0 - dlon, lat0 - dlat), self._cell(lon0 + dlon, lat0 + dlat)
+        cx, cy = self._cell(lon0, lat0)
+        out = []
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                if (x, y) == (cx, cy):
+                    out.append((x, y))
+                    continue
+                east, north = offset_km(lon0, lat0, (x + 0.5)*self.cell, (y + 0.5)*self.cell)
+                half_diag = 0.5 * math.hypot(self.cell * KM_PER_DEG_LON * math.cos(math.radians(lat0)),
+                                             self.cell * KM_PER_DEG_LAT)
+                dist = math.hypot(east, north)
+                if dist - half_diag > rng:
+                    continue
+                margin = math.degrees(math.asin(min(1.0, half_diag / max(dist, 1e-9))))
+                if bearing_in(math.degrees(math.atan2(east, north)) % 360, left, right, margin):
+                    out.append((x, y))
+        return out
+
+    def _remove(self, camera: str) -> None:
+        for c in self.registered.pop(camera, []):
+            self.cells[c].discard(camera)
+            if not self.cells[c]:
+                del self.cells[c]
+        self.views.pop(camera, None)
+
+    def update(self, cameras: Any) -> int:
+        '''
+        Bring the index in line with a camera table (indexed by camera id,
+        with longitude, latitude, elevation_km, fov_lft and fov_rt
+        columns). Returns the number of cameras added, moved or removed.
+        '''
+        seen = set()
+        n = 0
+        for camera, row in cameras.iterrows():
+            seen.add(camera)
+            view = self._view(row)
+            if view == self.views.get(camera):
+                continue
+            n += 1
+            self._remove(camera)
+            if view is None:
+                continue
+            self.views[camera] = view
+            self.registered[camera] = self._cells_for(view)
+            for c in self.registered[camera]:
+                self.cells.setdefault(c, set()).add(camera)
+        for camera in set(self.views) - seen:
+            self._remove(camera)
+            n += 1
+        return n
+
+    def sees(self, camera: str, lon: float, lat: float) -> bool:
+        lon0, lat0, rng, left, right = self.views[camera]
+        east, north = offset_km(lon0, lat0, lon, lat)
+        if math.hypot(east, north) > rng:
+            return False
+        if east == 0 and north == 0:
+            return True
+        return bearing_in(math.degrees(math.atan2(east, north)) % 360, left, right)
+
+    def bearing(self, camera: str, lon: float, lat: float) -> Tuple[float, float]:
+        '''
+        Bearing (degrees) and distance (km) from a camera to a point.
+        '''
+        lon0, lat0 = self.views[camera][:2]
+        east, north = offset_km(lon0, lat0, lon, lat)
+        return math.degrees(math.atan2(east, north)) % 360, math.hypot(east, north)
+
+    def point(self, lon: float, lat: float) -> List[str]:
+        '''
+        Cameras that could see a point, nearest first.
+        '''
+        found = [c for c in self.cells.get(self._cell(lon, lat), ()) if self.sees(c, lon, lat)]
+        return sorted(found, key=lambda c: self.bearing(c, lon, lat)[1])
+
+    def _meets_box(self, camera: str, lon0: float, lat0: float, lon1: float, lat1: float) -> bool:
+        '''
+        Whether a camera's wedge overlaps a bounding box anywhere.
+
+        In the camera's local projection the box is a rectangle. Within
+        the wedge's bearing span, the nearest point of each side is one of
+        its corners, a point where a wedge edge crosses it, or the foot of
+        the perpendicular from the camera, so only those need checking.
+        '''
+        clon, clat, rng, left, right = self.views[camera]
+        x0, y0 = offset_km(clon, clat, lon0, lat0)
+        x1, y1 = offset_km(clon, clat, lon1, lat1)
+        if x0 <= 0 <= x1 and y0 <= 0 <= y1:
+            return True
+        if math.hypot(max(x0, 0, -x1), max(y0, 0, -y1)) > rng:
+            return False
+        if left is None or right is None:
+            return True
+
+        corners = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        points = list(corners)
+        for (ax, ay), (bx, by) in zip(corners, corners[1:] + corners[:1]):
+            dx, dy = bx - ax, by - ay
+            t = max(0.0, min(1.0, -(ax*dx + ay*dy) / (dx*dx + dy*dy or 1.0)))
+            points.append((ax + t*dx, ay + t*dy))
+            for bearing in (left, right):
+                ex, ey = math.sin(math.radians(bearing)), math.cos(math.radians(bearing))
+                det = dx*ey - dy*ex
+                if det == 0:
+                    continue
+                ## Solve ax + s*dx = r*ex, ay + s*dy = r*ey for r >= 0, 0 <= s <= 1.
+                s = (ay*ex - ax*ey) / det
+                r = (ay*dx - ax*dy) / det
+                if 0 <= s <= 1 and r >= 0:
+                    points.append((r*ex, r*ey))
+        return any(math.hypot(x, y) <= rng + 1e-9 and
+                   bearing_in(math.degrees(math.atan2(x, y)) % 360, left, right, 1e-6)
+                   for x, y in points)
+
+    def bbox(self, lon0: float, lat0: float, lon1: float, lat1: float) -> List[str]:
+        '''
+        Cameras that could see any part of a bounding box.
+        '''
+        (x0, y0), (x1, y1) = self._cell(lon0, lat0), self._cell(lon1, lat1)
+        candidates: Set[str] = set()
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                candidates |= self.cells.get((x, y), set())
+        return [c for c in sorted(candidates) if self._meets_box(c, lon0, lat0, lon1, lat1)]
+
+def frames_covering(conn, index: ViewshedIndex, lon: float, lat: float, at: datetime, \
+                    window: Optional[timedelta]=timedelta(minutes=10), \
+                    azimuth_tolerance: Optional[float]=None) -> List[Dict[str, Any]]:
+    '''
+    Archived frames from cameras that could see a point, taken within
+    `window` of `at`, closest in time first. A naive `at` is taken as UTC.
+
+    Frames are matched on the time in their paths, which carry the UTC
+    offset that `images.time_stamp` lacks. With `azimuth_tolerance`,
+    frames whose recorded pan azimuth points more than that many degrees
+    away from the point are left out.
+    '''
+    import sqlalchemy as SQL # type: ignore
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    cameras = index.point(lon, lat)
+    if not cameras:
+        return []
+    ## time_stamp is local wall-clock time, so allow for any UTC offset in
+    ## the database query, and compare exact times afterwards.
+    query = SQL.text('''
+        SELECT id, station, path, azimuth FROM images
+        WHERE station IN :stations AND time_stamp BETWEEN :lo AND :hi;''') \
+        .bindparams(SQL.bindparam('stations', expanding=True))
+    slack = window + timedelta(hours=14)
+    local = at.replace(tzinfo=None)
+    rows = conn.execute(query, stations=cameras, lo=local - slack, hi=local + slack).fetchall()
+
+    frames = []
+    for img_id, station, path, azimuth in rows:
+        match = regex_date.search(path)
+        if match is None:
+            continue
+        dt = datetime.fromisoformat(match.group(1)) - at
+        if abs(dt) > window:
+            continue
+        bearing, distance = index.bearing(station, lon, lat)
+        if azimuth_tolerance is not None and azimuth is not None and \
+                abs((azimuth - bearing + 180) % 360 - 180) > azimuth_tolerance:
+            continue
+        frames.append(dict(id=img_id, station=station, path=path, dt_seconds=dt.total_seconds(),
+                           bearing=bearing, distance_km=distance, azimuth=azimuth))
+    return sorted(frames, key=lambda f: abs(f['dt_seconds']))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from tools.alertwf import get_all_cameras
+
+    parser = ArgumentParser(description='Find cameras, and frames, that could see a location.')
+    parser.add_argument('lon', type=float)
+    parser.add_argument('lat', type=float)
+    parser.add_argument('--time', default=None,
+                        help='Also list archived frames near this time (ISO format; UTC unless an offset is given).')
+    parser.add_argument('--window', type=float, default=10,
+                        help='Minutes either side of --time to search.')
+    parser.add_argument('--max-range', type=float, default=50.0,
+                        help='Furthest distance (km) a camera is assumed to see.')
+    args = parser.parse_args()
+
+    index = ViewshedIndex(max_range_km=args.max_range)
+    index.update(get_all_cameras())
+    for camera in index.point(args.lon, args.lat):
+        bearing, distance = index.bearing(camera, args.lon, args.lat)
+        print(f'{camera:30s} bearing {bearing:5.1f}  distance {distance:5.1f}km')
+
+    if args.time:
+        from tools.db_util import get_sql_engine
+        with get_sql_engine().connect() as conn:
+            frames = frames_covering(conn, index, args.lon, args.lat,
+                                     datetime.fromisoformat(args.time),
+                                     timedelta(minutes=args.window))
+        for f in frames:
+            print(f"{f['dt_seconds']:+8.0f}s  {f['path']}")
@@ -0,0 +1,50 @@
+'''
+As-of join between images and hourly weather.
+
+Each image is paired with the weather observation for its station that
+is nearest in time, within a tolerance. Both sides are sorted by station
+and time once, and the matching is done with `pd.merge_asof`, which is a
+vectorized binary search rather than a scan per image.
+'''
+
+import pandas as pd # type: ignore
+from tools.manifest import regex_date
+from typing import Optional
+
+def image_times_utc(paths: pd.Series) -> pd.Series:
+    ## The images table stores local wall-clock time without an offset, but
+    ## the offset is part of every image path, so UTC is recovered from that.
+    stamps = paths.str.extract(regex_date, expand=False)
+    return pd.to_datetime(stamps, utc=True, errors='coerce').dt.tz_localize(None)
+
+def asof_join(images: pd.DataFrame, weather: pd.DataFrame, \
+              tolerance: Optional[pd.Timedelta]=pd.Timedelta('90min')) -> pd.DataFrame:
+    '''
+    Attach the nearest weather row to each image.
+
+    `images` needs columns id, station, utc; `weather` needs id, station,
+    time_stamp (UTC) plus any measurements. Naive times are taken as UTC.
+    Returns one row per image that had weather within `tolerance`, with
+    the weather id and the time difference in seconds.
+    '''
+    left = images.dropna(subset=['utc'])
+    right = weather.rename(columns={'id': 'weather_id', 'time_stamp': 'weather_time'})
+    ## merge_asof needs both keys of exactly the same dtype, which empty
+    ## frames (object) and different resolutions (us vs ns) are not.
+    left = left.assign(utc=pd.to_datetime(left['utc'], utc=True).astype('datetime64[ns, UTC]'))
+    right = right.assign(weather_time=pd.to_datetime(right['weather_time'], utc=True)
+                                        .astype('datetime64[ns, UTC]'))
+    if left.empty or right.empty:
+        return left.iloc[:0].assign(weather_id=pd.Series(dtype=int),
+                                    weather_time=right['weather_time'].iloc[:0],
+                                    dt_seconds=pd.Series(dtype=float)) \
+                   .rename(columns={'id': 'image_id'})
+
+    left = left.sort_values('utc')
+    right = right.sort_values('weather_time')
+    joined = pd.merge_asof(left, right, left_on='utc', right_on='weather_time',
+                           by='station', direction='nearest', tolerance=tolerance)
+    joined = joined.dropna(subset=['weather_id'])
+    joined['weather_id'] = joined['weather_id'].astype(int)
+    joined['dt_seconds'] = (joined['weather_time'] - joined['utc']).dt.total_seconds()
+    return joined.rename(columns={'id': 'image_id'})
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+'''
+Fill in the `azimuth`, `tilt` and `zoom` columns of the `images` table
+by reading the watermark burned into each frame (see tools/watermark.py).
+
+Frames are grouped by station and split into chunks of --chunk-size.
+A station's chunks are handled one after another, so its glyph templates
+are learned once and reused for the rest of its frames, while stations
+are spread over worker processes. Templates are saved to --templates
+after each chunk, and each chunk's results are committed as soon as
+it's done, so an interrupted run loses little. Frames whose watermark
+can't be read are marked `watermark_unreadable`, so later runs skip
+them; frames that couldn't be fetched are left to retry.
+
+    ./watermarks.py --start 2021-03-01 --end 2021-03-16 [--workers N]
+    ./watermarks.py --benchmark 50 --station Axis-Brightwood
+'''
+
+import json, os, time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from tools.db_util import get_sql_engine, SQL
+from tools.imgtools import read_image
+from tools.watermark import GlyphTemplates, extract_metadata, get_watermark_region, \
+    parse_stamp, read_band, tesseract
+from typing import Any, Dict, List, Optional, Tuple
+
+HOME = os.path.expanduser('~')
+
+def template_path(template_dir: str, station: str) -> str:
+    return os.path.join(template_dir, f'{station}.npz')
+
+def process_chunk(station: str, rows: List[Tuple[int, str]], template_dir: str, \
+                  bucket: Optional[str], local_root: Optional[str]) \
+                  -> Tuple[List[Dict[str, Any]], List[int], int]:
+    '''
+    Read the watermarks of a chunk of (id, path) rows for one station.
+    Returns the column updates, the ids of frames whose watermark can't be
+    read, and the number of frames that needed Tesseract.
+    '''
+    templates = GlyphTemplates.load(template_path(template_dir, station))
+    updates, unreadable, n_ocr = [], [], 0
+    for img_id, path in rows:
+        try:
+            data = read_image(path, bucket, local_root)
+        except Exception as e:
+            print('Error fetching', path, str(e))
+            continue
+        try:
+            ret, used_ocr = extract_metadata(data, templates, os.path.basename(path))
+        except Exception as e:
+            print('Error reading', path, str(e))
+            ret, used_ocr = None, False
+        n_ocr += used_ocr
+        if ret is None:
+            unreadable.append(img_id)
+        else:
+            azimuth, tilt, zoom = ret['loc']
+            updates.append(dict(id=img_id, azimuth=azimuth, tilt=tilt, zoom=zoom))
+    templates.save(template_path(template_dir, station))
+    return updates, unreadable, n_ocr
+
+def select_rows(conn, start: datetime, end: datetime, \
+                station: Optional[str]=None) -> Dict[str, List[Tuple[int, str]]]:
+    query = SQL.text('''
+            SELECT id, station, path FROM images
+            WHERE azimuth IS NULL AND watermark_unreadable IS NULL
+                AND time_stamp >= :start AND time_stamp < :end
+            ORDER BY time_stamp;
+        ''').bindparams(SQL.bindparam('start', type_=SQL.DateTime),
+                        SQL.bindparam('end', type_=SQL.DateTime))
+    by_station: Dict[str, List[Tuple[int, str]]] = dict()
+    for img_id, st, path in conn.execute(query, dict(start=start, end=end)).fetchall():
+        if station is None or st == station:
+            by_station.setdefault(st, []).append((img_id, path))
+    return by_station
+
+def do_watermarks(start: datetime, end: datetime, template_dir: str, bucket: Optional[str], \
+                  local_root: Optional[str]=None, workers: Optional[int]=None, \
+                  station: Optional[str]=None, chunk_size: Optional[int]=1000) -> None:
+    params = dict(id=SQL.Integer, azimuth=SQL.Float, tilt=SQL.Float, zoom=SQL.Float)
+    update_query = SQL.text('''
+            UPDATE images SET azimuth=:azimuth, tilt=:tilt, zoom=:zoom WHERE id=:id;
+        ''').bindparams(*[SQL.bindparam(p, type_=t) for p,t in params.items()])
+    unreadable_query = SQL.text('''
+            UPDATE images SET watermark_unreadable=1 WHERE id=:id;
+        ''').bindparams(SQL.bindparam('id', type_=SQL.Integer))
+
+    engine = get_sql_engine()
+    with engine.connect() as conn:
+        by_station = select_rows(conn, start, end, station)
+        total = sum(len(rows) for rows in by_station.values())
+        print('Reading watermarks for', total, 'images from', len(by_station), 'stations')
+
+        chunks = {st: [rows[i:i+chunk_size] for i in range(0, len(rows), chunk_size)]
+                  for st, rows in by_station.items()}
+        n, n_bad, n_ocr, t0 = 0, 0, 0, time.time()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            submit = lambda st: pool.submit(process_chunk, st, chunks[st].pop(0), template_dir,
+                                            bucket, local_root)
+            pending = {submit(st): st for st in chunks}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    st = pending.pop(future)
+                    updates, unreadable, ocr = future.result()
+                    if updates or unreadable:
+                        with conn.begin():
+                            if updates:
+                                conn.execute(update_query, updates)
+                            if unreadable:
+                                conn.execute(unreadable_query, [dict(id=i) for i in unreadable])
+                    n += len(updates)
+                    n_bad += len(unreadable)
+                    n_ocr += ocr
+                    ## The station's next chunk reuses the templates this one saved.
+                    if chunks[st]:
+                        pending[submit(st)] = st
+    dt = time.time() - t0
+    print(f'Updated {n} records in {dt:.1f}s ({n/max(dt,1e-9):.1f}/s), '
+          f'{n_ocr} needed Tesseract, {n_bad} unreadable')
+
+def benchmark(paths: List[str], template_dir: str, station: str, \
+              bucket: Optional[str], local_root: Optional[str]) -> None:
+    '''
+    Compare the throughput of template matching against running
+    Tesseract on every frame, as the notebook does.
+    '''
+    images = [read_image(p, bucket, local_root) for p in paths]
+
+    t0 = time.time()
+    for data in images:
+        parse_stamp(tesseract(get_watermark_region(read_band(data))))
+    t_ocr = time.time() - t0
+
+    templates = GlyphTemplates.load(template_path(template_dir, station))
+    t0 = time.time()
+    n_ocr = sum(extract_metadata(data, templates)[1] for data in images)
+    t_fast = time.time() - t0
+
+    n = len(images)
+    print(f'Tesseract only: {n/t_ocr:8.1f} frames/s')
+    print(f'Templates:      {n/t_fast:8.1f} frames/s ({n_ocr} of {n} fell back to Tesseract)')
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--start', type=datetime.fromisoformat, default=datetime(1970,1,1),
+                        help='Only process images taken on or after this date.')
+    parser.add_argument('--end', type=datetime.fromisoformat, default=datetime.now(),
+                        help='Only process images taken before this date.')
+    parser.add_argument('--station', default=None, help='Only process one station.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per core).')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Number of frames per task, committed once each is done.')
+    parser.add_argument('--templates', default=os.path.join(HOME, '.alertwf', 'glyphs'),
+                        help='Directory in which to cache glyph templates.')
+    parser.add_argument('--local-root', default=None,
+                        help=('Read images from this directory instead of S3. '
+                            + 'Paths in the images table are relative to it.'))
+    parser.add_argument('--benchmark', type=int, default=None, metavar='N',
+                        help='Time both OCR methods on N frames of --station and exit.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.templates):
+        os.makedirs(args.templates)
+
+    bucket = None
+    if args.local_root is None:
+        with open(os.path.join(HOME, 'Documents', 'secrets.json'),'r') as secrets_file:
+            bucket = json.load(secrets_file)['aws']['bucket']
+
+    if args.benchmark:
+        assert args.station, 'Benchmarking requires --station'
+        with get_sql_engine().connect() as conn:
+            query = SQL.text('SELECT path FROM images WHERE station=:st ORDER BY time_stamp DESC LIMIT :n;')
+            paths = [r[0] for r in conn.execute(query, dict(st=args.station, n=args.benchmark))]
+        benchmark(paths, args.templates, args.station, bucket, args.local_root)
+    else:
+        do_watermarks(args.start, args.end, args.templates, bucket, args.local_root,
+                      args.workers, args.station, args.chunk_size)